@@ -842,17 +842,19 @@ async def export_user_data(callback: CallbackQuery, state: FSMContext, session,
         user_service = UserService(session)
         user = await user_service.get_user_by_telegram_id(callback.from_user.id)
         
-        # Собираем все данные пользователя
-        user_data = await user_service.export_user_data(user.id)
-        
-        # Создаем JSON файл
-        import json
+        # Пишем данные пользователя прямо в JSON файл
+        import os
         import tempfile
         
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False, encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2, default=str)
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.json', delete=False) as f:
+            exported = await user_service.export_user_data(user.id, f)
             temp_path = f.name
         
+        if not exported:
+            os.unlink(temp_path)
+            await callback.answer("❌ Ошибка при экспорте данных", show_alert=True)
+            return
+        
         # Отправляем файл
         from aiogram.types import FSInputFile
         file = FSInputFile(temp_path, filename=f"user_data_{user.telegram_id}.json")
@@ -875,7 +877,6 @@ async def export_user_data(callback: CallbackQuery, state: FSMContext, session,
         )
         
         # Удаляем временный файл
-        import os
         os.unlink(temp_path)
         
         # Логируем экспорт
@@ -110,8 +110,8 @@ async def show_server_info(callback: CallbackQuery, session: AsyncSession, state
             return
         
         # Получаем детальную информацию
-        load = await server_service._calculate_server_load(server)
-        health = await server_service.check_server_health(server_id)
+        load = server_service._calculate_server_load(server)
+        health = await server_service.check_server_health(server_id, server=server)
         
         # Формируем информацию о сервере
         text = f"🌍 **Сервер {server.name}**\n\n"
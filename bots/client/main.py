@@ -17,6 +17,7 @@ from loguru import logger
 
 from config.settings import settings
 from config.database import init_database, init_redis, close_connections
+from core.services.activity_service import close_buffers
 from bots.shared.middleware.database import DatabaseMiddleware
 from bots.shared.middleware.logging import LoggingMiddleware
 from bots.client.middleware.auth import AuthMiddleware
@@ -135,6 +136,9 @@ class ClientBot:
         try:
             logger.info("Client bot shutting down...")
             
+            # Дописываем накопленные записи активности и истории серверов
+            await close_buffers()
+            
             # Закрываем соединения
             await close_connections()
             
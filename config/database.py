@@ -4,13 +4,22 @@
 
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Awaitable, Callable, TypeVar
+import asyncio
+import orjson
 import redis.asyncio as redis
 from loguru import logger
 
-from config.settings import settings, redis_settings
+from config.settings import settings, db_settings, redis_settings
+
+T = TypeVar("T")
+
+
+def json_serializer(value: Any) -> str:
+    """JSON сериализатор для JSON колонок (даты - в ISO формате, Enum - значением)"""
+    return orjson.dumps(value).decode()
 
 
 class Base(DeclarativeBase):
@@ -26,11 +35,17 @@ class DatabaseManager:
         self.async_engine = create_async_engine(
             settings.DATABASE_URL,
             echo=settings.DEBUG,
-            pool_size=10,
-            max_overflow=20,
-            pool_pre_ping=True,
-            pool_recycle=3600,
-            future=True
+            pool_size=db_settings.POOL_SIZE,
+            max_overflow=db_settings.MAX_OVERFLOW,
+            pool_pre_ping=db_settings.POOL_PRE_PING,
+            pool_recycle=db_settings.POOL_RECYCLE,
+            future=True,
+            json_serializer=json_serializer,
+            # Переиспользуем подготовленные выражения на соединении
+            connect_args={
+                "statement_cache_size": db_settings.STATEMENT_CACHE_SIZE,
+                "prepared_statement_cache_size": db_settings.STATEMENT_CACHE_SIZE
+            }
         )
         
         # Синхронный движок (для миграций)
@@ -41,7 +56,8 @@ class DatabaseManager:
             max_overflow=20,
             pool_pre_ping=True,
             pool_recycle=3600,
-            future=True
+            future=True,
+            json_serializer=json_serializer
         )
         
         # Фабрика сессий
@@ -56,6 +72,19 @@ class DatabaseManager:
             expire_on_commit=False
         )
     
+    async def warm_up_pool(self, connections: int = db_settings.POOL_SIZE):
+        """Заранее открыть соединения пула, чтобы первые апдейты не ждали подключения"""
+        async def touch():
+            async with self.async_engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        
+        results = await asyncio.gather(*(touch() for _ in range(connections)), return_exceptions=True)
+        failed = sum(isinstance(result, Exception) for result in results)
+        if failed:
+            logger.warning("Pool warm-up: {} of {} connections failed", failed, connections)
+        else:
+            logger.info("Pool warmed up with {} connections", connections)
+    
     async def close(self):
         """Закрыть соединения"""
         await self.async_engine.dispose()
@@ -135,6 +164,30 @@ async def get_db() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+async def run_in_own_session(
+    action: Callable[[AsyncSession], Awaitable[T]],
+    commit: bool = False
+) -> T:
+    """
+    Выполнить действие в отдельной сессии из пула
+    
+    AsyncSession не допускает конкурентных запросов, поэтому параллельные
+    задачи (asyncio.gather, фоновые задачи) берут каждая свою сессию.
+    
+    Args:
+        action: Корутина-функция, получающая сессию
+        commit: Закоммитить сессию после успешного выполнения
+        
+    Returns:
+        Результат action
+    """
+    async with db_manager.get_async_session() as session:
+        result = await action(session)
+        if commit:
+            await session.commit()
+        return result
+
+
 async def get_redis() -> redis.Redis:
     """Dependency для получения Redis клиента"""
     return await redis_manager.get_redis()
@@ -150,6 +203,9 @@ async def init_database():
             
             # Создаем таблицы
             await conn.run_sync(Base.metadata.create_all)
+        
+        if db_settings.POOL_WARMUP:
+            await db_manager.warm_up_pool()
             
         logger.info("Database initialized successfully")
         
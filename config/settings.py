@@ -3,7 +3,7 @@
 """
 
 import os
-from typing import Optional, List
+from typing import Optional, List, FrozenSet
 from pydantic import BaseSettings, validator
 from pathlib import Path
 
@@ -94,6 +94,7 @@ class Settings(BaseSettings):
     DEFAULT_SUBSCRIPTION_DAYS: int = 30
     TRIAL_SUBSCRIPTION_DAYS: int = 3
     TRIAL_TRAFFIC_LIMIT_GB: int = 10
+    SUBSCRIPTION_EXPIRY_INTERVAL: int = 60
     
     # Лимиты и троттлинг
     RATE_LIMIT_REQUESTS: int = 30
@@ -107,6 +108,8 @@ class Settings(BaseSettings):
     # Мониторинг
     SENTRY_DSN: Optional[str] = None
     ENABLE_METRICS: bool = True
+    SERVER_STATS_CONCURRENCY: int = 8
+    SERVER_STATS_TIMEOUT: int = 30
     
     # Логирование
     LOG_LEVEL: str = "INFO"
@@ -129,7 +132,7 @@ class Settings(BaseSettings):
     CURRENCY: str = "RUB"
     
     # Настройки для российских пользователей
-    RUSSIA_COUNTRY_CODES: List[str] = ["RU", "BY", "KZ"]
+    RUSSIA_COUNTRY_CODES: FrozenSet[str] = frozenset({"RU", "BY", "KZ"})
     PREFERRED_PROTOCOLS_RU: List[str] = ["vless", "vmess", "trojan"]
     
     class Config:
@@ -141,16 +144,22 @@ class Settings(BaseSettings):
 class DatabaseSettings(BaseSettings):
     """Настройки базы данных"""
     
-    # Пул соединений
+    # Пул соединений (на процесс). Пул есть у каждого из четырех процессов
+    # docker-compose: (POOL_SIZE + MAX_OVERFLOW) * 4 = 120 должно оставаться
+    # ниже max_connections PostgreSQL (200 в docker-compose.yml)
     POOL_SIZE: int = 10
     MAX_OVERFLOW: int = 20
     POOL_PRE_PING: bool = True
     POOL_RECYCLE: int = 3600
+    POOL_WARMUP: bool = True
     
     # Настройки соединения
     CONNECT_TIMEOUT: int = 30
     COMMAND_TIMEOUT: int = 60
     
+    # Кеш подготовленных выражений asyncpg
+    STATEMENT_CACHE_SIZE: int = 1024
+    
     class Config:
         env_file = ".env"
         env_prefix = "DB_"
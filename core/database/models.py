@@ -10,6 +10,7 @@ from sqlalchemy import (
     ForeignKey, Enum, Numeric, BigInteger, Index
 )
 from sqlalchemy.orm import relationship, Mapped, mapped_column
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql import func
 from config.database import Base
 
@@ -175,10 +176,42 @@ class Server(Base):
     vpn_configs: Mapped[List["VpnConfig"]] = relationship(
         "VpnConfig", back_populates="server", lazy="selectin"
     )
+    
     server_stats: Mapped[List["ServerStats"]] = relationship(
         "ServerStats", back_populates="server", lazy="selectin"
     )
     
+    @hybrid_property
+    def load(self) -> float:
+        """Взвешенная нагрузка сервера (0.0 - 1.0)"""
+        user_load = self.current_users / self.max_users if self.max_users > 0 else 0
+        total_load = (
+            user_load * 0.5
+            + float(self.cpu_usage) / 100.0 * 0.3
+            + float(self.memory_usage) / 100.0 * 0.2
+        )
+        return min(total_load, 1.0)
+    
+    @load.expression
+    def load(cls):
+        """Та же нагрузка в SQL - для фильтрации и сортировки в БД"""
+        user_load = func.coalesce(cls.current_users * 1.0 / func.nullif(cls.max_users, 0), 0)
+        return func.least(
+            user_load * 0.5 + cls.cpu_usage / 100.0 * 0.3 + cls.memory_usage / 100.0 * 0.2,
+            1.0
+        )
+    
+    @property
+    def supported_protocols_set(self) -> frozenset:
+        """Поддерживаемые протоколы для проверок вхождения (кешируется до изменения списка)"""
+        protocols = self.supported_protocols or []
+        cached = self.__dict__.get("_protocols_set_cache")
+        # Сравниваем с копией по содержимому: изменение списка на месте тоже сбрасывает кеш
+        if cached is None or cached[0] != protocols:
+            cached = (list(protocols), frozenset(protocols))
+            self.__dict__["_protocols_set_cache"] = cached
+        return cached[1]
+    
     # Индексы
     __table_args__ = (
         Index("idx_server_country", "country_code"),
@@ -310,6 +343,15 @@ class Payment(Base):
     
     # Отношения
     user: Mapped["User"] = relationship("User", back_populates="payments")
+    
+    # Индексы
+    __table_args__ = (
+        # Покрывающий индекс для проверки лимитов платежей
+        Index(
+            "idx_payment_user_created", "user_id", "created_at",
+            postgresql_include=["status", "amount"]
+        ),
+    )
 
 
 class SupportTicket(Base):
@@ -2,10 +2,15 @@
 Репозитории для работы с базой данных
 """
 
-from typing import Optional, List, Dict, Any
-from datetime import datetime, timedelta
+import time
+from functools import cached_property
+from typing import Optional, List, Dict, Any, Tuple, AsyncIterator, NamedTuple, Sequence
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, delete, func, and_, or_
+from sqlalchemy import select, insert, update, delete, func, and_, or_, tuple_, bindparam, literal, case, column, JSON, Integer, Float
+from sqlalchemy import values as values_clause, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import selectinload, joinedload
 from loguru import logger
 
@@ -17,6 +22,136 @@ from core.database.models import (
 )
 
 
+# Общий кеш скомпилированных выражений для горячих запросов платежей
+_PAYMENT_COMPILED_CACHE: Dict[Any, Any] = {}
+
+# Выражения для частых запросов серверов собираются один раз при импорте
+_SERVER_COMPILED_CACHE: Dict[Any, Any] = {}
+
+_ACTIVE_SERVERS_STMT = (
+    select(Server)
+    .where(and_(Server.is_active == True, Server.is_maintenance == False))
+    .order_by(Server.country, Server.name)
+    .execution_options(compiled_cache=_SERVER_COMPILED_CACHE)
+)
+
+_SERVER_BY_ID_STMT = (
+    select(Server)
+    .where(Server.id == bindparam("server_id"))
+    .execution_options(compiled_cache=_SERVER_COMPILED_CACHE)
+)
+
+# Тарифы меняются редко: кешируем их снимки, не привязанные к сессии
+PLAN_CACHE_TTL = 3600
+
+
+class PlanInfo(NamedTuple):
+    """Снимок тарифного плана (не привязан к сессии)"""
+    id: int
+    name: str
+    duration_days: int
+    price: Decimal
+    currency: str
+    traffic_limit_gb: Optional[int]
+    device_limit: int
+    is_active: bool
+    is_trial: bool
+
+
+_PLAN_CACHE: Dict[int, Tuple[float, PlanInfo]] = {}
+
+
+def invalidate_plan_cache(plan_id: Optional[int] = None):
+    """Сбросить кеш тарифов (один план или все)"""
+    if plan_id is None:
+        _PLAN_CACHE.clear()
+    else:
+        _PLAN_CACHE.pop(plan_id, None)
+
+
+# Системные флаги (maintenance_mode и т.п.) читаются на каждом апдейте:
+# короткий TTL, изменения через set_setting сбрасывают ключ сразу
+SETTINGS_CACHE_TTL = 5
+
+_SETTINGS_CACHE: Dict[str, Tuple[float, Optional[str]]] = {}
+
+
+def invalidate_settings_cache(key: Optional[str] = None):
+    """Сбросить кеш системных настроек (один ключ или все)"""
+    if key is None:
+        _SETTINGS_CACHE.clear()
+    else:
+        _SETTINGS_CACHE.pop(key, None)
+
+
+_SERVERS_BY_PROTOCOL_STMTS = {
+    protocol: (
+        select(Server)
+        .where(
+            and_(
+                Server.is_active == True,
+                Server.supported_protocols.contains([protocol.value])
+            )
+        )
+        .execution_options(compiled_cache=_SERVER_COMPILED_CACHE)
+    )
+    for protocol in VpnProtocol
+}
+
+# Горячие запросы подписок: строятся один раз, значения - через bindparam
+_SUBSCRIPTION_COMPILED_CACHE: Dict[Any, Any] = {}
+
+# План, сервер и пользователь приходят тем же запросом (JOIN), а их
+# selectin-коллекции не подгружаются - сервисам они не нужны
+_SUBSCRIPTION_BY_ID_STMT = (
+    select(Subscription)
+    .where(Subscription.id == bindparam("subscription_id"))
+    .options(
+        joinedload(Subscription.plan).lazyload("*"),
+        joinedload(Subscription.server).lazyload("*"),
+        joinedload(Subscription.user).lazyload("*")
+    )
+    .execution_options(compiled_cache=_SUBSCRIPTION_COMPILED_CACHE)
+)
+
+_SUBSCRIPTION_STATUS_STMT = (
+    update(Subscription)
+    .where(Subscription.id == bindparam("subscription_id"))
+    .values(status=bindparam("new_status"), updated_at=bindparam("now"))
+    .execution_options(compiled_cache=_SUBSCRIPTION_COMPILED_CACHE)
+)
+
+_ACTIVE_SUBSCRIPTION_STMT = (
+    select(Subscription)
+    .where(
+        and_(
+            Subscription.user_id == bindparam("user_id"),
+            Subscription.status == SubscriptionStatus.ACTIVE,
+            Subscription.expires_at > bindparam("now")
+        )
+    )
+    .options(
+        selectinload(Subscription.server),
+        selectinload(Subscription.plan),
+        selectinload(Subscription.vpn_configs)
+    )
+    .execution_options(compiled_cache=_SUBSCRIPTION_COMPILED_CACHE)
+)
+
+_EXPIRING_SUBSCRIPTIONS_STMT = (
+    select(Subscription)
+    .where(
+        and_(
+            Subscription.status == SubscriptionStatus.ACTIVE,
+            Subscription.expires_at <= bindparam("expiry_time"),
+            Subscription.expires_at > bindparam("now")
+        )
+    )
+    .options(selectinload(Subscription.user))
+    .execution_options(compiled_cache=_SUBSCRIPTION_COMPILED_CACHE)
+)
+
+
 class BaseRepository:
     """Базовый репозиторий"""
     
@@ -30,11 +165,87 @@ class BaseRepository:
     async def rollback(self):
         """Откатить изменения"""
         await self.session.rollback()
+    
+    async def _update_with_activity(
+        self,
+        model: Any,
+        row_id: int,
+        user_id_column: Any,
+        action: str,
+        details: Optional[Dict[str, Any]],
+        values: Dict[str, Any]
+    ) -> Optional[int]:
+        """
+        Обновить строку model по id и записать активность одним запросом
+        
+        WITH upd AS (UPDATE ... RETURNING <user_id_column>)
+        INSERT INTO user_activities SELECT ... FROM upd
+        
+        created_at активности - тот же utcnow(), что у буферизованных записей.
+        
+        Returns:
+            Optional[int]: ID пользователя или None, если строка не найдена
+        """
+        now = datetime.utcnow()
+        updated = (
+            update(model)
+            .where(model.id == row_id)
+            .values(updated_at=now, **values)
+            .returning(user_id_column.label("user_id"))
+            .cte("updated_row")
+        )
+        result = await self.session.execute(
+            insert(UserActivity)
+            .from_select(
+                ["user_id", "action", "details", "created_at"],
+                select(
+                    updated.c.user_id,
+                    literal(action),
+                    literal(details, JSON),
+                    literal(now)
+                )
+            )
+            .returning(UserActivity.user_id)
+        )
+        return result.scalar_one_or_none()
 
 
 class UserRepository(BaseRepository):
     """Репозиторий для работы с пользователями"""
     
+    async def update_with_activity(
+        self,
+        user_id: int,
+        action: str,
+        details: Optional[Dict[str, Any]] = None,
+        **values
+    ) -> Optional[int]:
+        """Обновить пользователя и записать активность одним запросом (ID или None)"""
+        return await self._update_with_activity(User, user_id, User.id, action, details, values)
+    
+    async def insert_or_touch(self, **values) -> Tuple[User, bool]:
+        """
+        Создать пользователя или, если telegram_id уже занят, обновить last_activity
+        
+        INSERT ... ON CONFLICT (telegram_id) DO UPDATE ... RETURNING -
+        без гонки между параллельными апдейтами одного пользователя.
+        
+        Returns:
+            Tuple[User, bool]: Пользователь и признак создания новой записи
+        """
+        result = await self.session.execute(
+            pg_insert(User)
+            .values(**values)
+            .on_conflict_do_update(
+                index_elements=[User.telegram_id],
+                set_={"last_activity": datetime.utcnow()}
+            )
+            .returning(User, literal_column("xmax = 0").label("inserted"))
+            .execution_options(populate_existing=True)
+        )
+        user, inserted = result.one()
+        return user, inserted
+    
     async def get_by_telegram_id(self, telegram_id: int) -> Optional[User]:
         """Получить пользователя по Telegram ID"""
         try:
@@ -109,17 +320,45 @@ class UserRepository(BaseRepository):
 class PaymentRepository(BaseRepository):
     """Репозиторий для работы с платежами"""
     
+    async def get_by_id(self, payment_id: int) -> Optional[Payment]:
+        """Получить платеж по ID"""
+        try:
+            result = await self.session.execute(
+                select(Payment)
+                .where(Payment.id == payment_id)
+                .execution_options(compiled_cache=_PAYMENT_COMPILED_CACHE)
+            )
+            return result.scalar_one_or_none()
+        except Exception as e:
+            logger.error(f"Error getting payment by id {payment_id}: {e}")
+            return None
+    
     async def get_by_external_id(self, external_id: str) -> Optional[Payment]:
         """Получить платеж по внешнему ID"""
         try:
             result = await self.session.execute(
-                select(Payment).where(Payment.external_payment_id == external_id)
+                select(Payment)
+                .where(Payment.external_payment_id == external_id)
+                .execution_options(compiled_cache=_PAYMENT_COMPILED_CACHE)
             )
             return result.scalar_one_or_none()
         except Exception as e:
             logger.error(f"Error getting payment by external_id {external_id}: {e}")
             return None
     
+    async def get_notify_fields(self, payment_id: int) -> Optional[Any]:
+        """Получить поля платежа для уведомлений (user_id, amount, currency)"""
+        try:
+            result = await self.session.execute(
+                select(Payment.user_id, Payment.amount, Payment.currency)
+                .where(Payment.id == payment_id)
+                .execution_options(compiled_cache=_PAYMENT_COMPILED_CACHE)
+            )
+            return result.first()
+        except Exception as e:
+            logger.error(f"Error getting notify fields for payment {payment_id}: {e}")
+            return None
+    
     async def get_user_payments(self, user_id: int) -> List[Payment]:
         """Получить платежи пользователя"""
         try:
@@ -133,6 +372,94 @@ class PaymentRepository(BaseRepository):
             logger.error(f"Error getting user payments {user_id}: {e}")
             return []
     
+    async def stream_user_payments(self, user_id: int, batch_size: int = 500) -> AsyncIterator[Payment]:
+        """Потоково получить платежи пользователя (серверный курсор, пачками)"""
+        result = await self.session.stream_scalars(
+            select(Payment)
+            .where(Payment.user_id == user_id)
+            .order_by(Payment.created_at.desc())
+            .execution_options(yield_per=batch_size)
+        )
+        async for payment in result:
+            yield payment
+    
+    async def get_limit_counters(
+        self,
+        user_id: int,
+        hour_ago: datetime,
+        day_ago: datetime
+    ) -> Tuple[int, Decimal]:
+        """Получить счетчики лимитов: (платежей за час, сумма завершенных за день)"""
+        result = await self.session.execute(
+            select(
+                func.count().filter(Payment.created_at >= hour_ago),
+                func.coalesce(
+                    func.sum(Payment.amount).filter(Payment.status == PaymentStatus.COMPLETED),
+                    0
+                )
+            )
+            .select_from(Payment)
+            .where(
+                and_(
+                    Payment.user_id == user_id,
+                    Payment.created_at >= day_ago
+                )
+            )
+        )
+        hour_count, day_sum = result.one()
+        return hour_count, Decimal(day_sum)
+    
+    async def aggregate_user_behavior(self, user_id: int) -> List[Any]:
+        """Агрегаты платежей пользователя по методу и статусу
+        (payment_method, status, count, sum_amount, min_created, max_created)"""
+        try:
+            result = await self.session.execute(
+                select(
+                    Payment.payment_method,
+                    Payment.status,
+                    func.count(),
+                    func.sum(Payment.amount),
+                    func.min(Payment.created_at),
+                    func.max(Payment.created_at)
+                )
+                .where(Payment.user_id == user_id)
+                .group_by(Payment.payment_method, Payment.status)
+            )
+            return result.all()
+        except Exception as e:
+            logger.error(f"Error aggregating user payments {user_id}: {e}")
+            return []
+    
+    async def get_user_avg_interval_days(self, user_id: int) -> float:
+        """Средний интервал между завершенными платежами пользователя (в днях)"""
+        try:
+            prev_created = func.lag(Payment.created_at).over(order_by=Payment.created_at)
+            intervals = (
+                select(
+                    Payment.created_at.label("created_at"),
+                    prev_created.label("prev_created")
+                )
+                .where(
+                    and_(
+                        Payment.user_id == user_id,
+                        Payment.status == PaymentStatus.COMPLETED
+                    )
+                )
+                .subquery()
+            )
+            result = await self.session.execute(
+                select(
+                    func.avg(
+                        func.extract("epoch", intervals.c.created_at - intervals.c.prev_created) / 86400.0
+                    )
+                )
+            )
+            avg_days = result.scalar()
+            return float(avg_days) if avg_days is not None else 0.0
+        except Exception as e:
+            logger.error(f"Error getting payment interval for user {user_id}: {e}")
+            return 0.0
+    
     async def create(self, **kwargs) -> Payment:
         """Создать платеж"""
         try:
@@ -159,12 +486,41 @@ class PaymentRepository(BaseRepository):
                 update(Payment)
                 .where(Payment.id == payment_id)
                 .values(**update_data)
+                .execution_options(compiled_cache=_PAYMENT_COMPILED_CACHE)
             )
             return result.rowcount > 0
         except Exception as e:
             logger.error(f"Error updating payment status {payment_id}: {e}")
             return False
     
+    async def complete_by_external_id(self, external_id: str) -> Optional[Any]:
+        """Завершить платеж по внешнему ID одним UPDATE (id, user_id, plan_id)
+        
+        Уже завершенный платеж не обновляется, повторный webhook вернет None.
+        """
+        try:
+            now = datetime.utcnow()
+            result = await self.session.execute(
+                update(Payment)
+                .where(
+                    and_(
+                        Payment.external_payment_id == external_id,
+                        Payment.status != PaymentStatus.COMPLETED
+                    )
+                )
+                .values(
+                    status=PaymentStatus.COMPLETED,
+                    paid_at=now,
+                    updated_at=now
+                )
+                .returning(Payment.id, Payment.user_id, Payment.plan_id)
+                .execution_options(compiled_cache=_PAYMENT_COMPILED_CACHE)
+            )
+            return result.first()
+        except Exception as e:
+            logger.error(f"Error completing payment by external_id {external_id}: {e}")
+            return None
+    
     async def get_pending_payments(self) -> List[Payment]:
         """Получить ожидающие платежи"""
         try:
@@ -177,6 +533,40 @@ class PaymentRepository(BaseRepository):
         except Exception as e:
             logger.error(f"Error getting pending payments: {e}")
             return []
+    
+    async def revenue_rollup(self, since: datetime) -> List[Any]:
+        """Сводка доходов одним запросом по наборам группировки (день, валюта, метод, итог)
+        
+        Строки: (day, currency, payment_method, grouping, revenue, completed_count, total_count),
+        grouping - битовая маска GROUPING(day, currency, payment_method).
+        """
+        try:
+            day = func.date_trunc("day", Payment.created_at)
+            completed = Payment.status == PaymentStatus.COMPLETED
+            result = await self.session.execute(
+                select(
+                    day.label("day"),
+                    Payment.currency,
+                    Payment.payment_method,
+                    func.grouping(day, Payment.currency, Payment.payment_method).label("grouping"),
+                    func.coalesce(func.sum(Payment.amount).filter(completed), 0).label("revenue"),
+                    func.count().filter(completed).label("completed_count"),
+                    func.count().label("total_count")
+                )
+                .where(Payment.created_at >= since)
+                .group_by(
+                    func.grouping_sets(
+                        tuple_(day),
+                        tuple_(Payment.currency),
+                        tuple_(Payment.payment_method),
+                        tuple_()
+                    )
+                )
+            )
+            return result.all()
+        except Exception as e:
+            logger.error(f"Error getting revenue rollup since {since}: {e}")
+            return []
 
 
 class SupportTicketRepository(BaseRepository):
@@ -324,6 +714,14 @@ class UserActivityRepository(BaseRepository):
         except Exception as e:
             logger.error(f"Error logging user activity: {e}")
     
+    async def log_activities_bulk(self, activities: List[Dict[str, Any]]) -> int:
+        """Записать пачку активностей одним INSERT"""
+        if not activities:
+            return 0
+        
+        await self.session.execute(insert(UserActivity), activities)
+        return len(activities)
+    
     async def get_user_activities(self, user_id: int, limit: int = 50) -> List[UserActivity]:
         """Получить активность пользователя"""
         try:
@@ -356,6 +754,60 @@ class UserActivityRepository(BaseRepository):
         except Exception as e:
             logger.error(f"Error getting activities by action {action}: {e}")
             return []
+    
+    async def get_daily_counts(self, user_id: int, days: int = 7) -> Dict[date, int]:
+        """Количество действий пользователя по дням за последние days дней"""
+        try:
+            since_date = datetime.combine(datetime.utcnow().date() - timedelta(days=days - 1), datetime.min.time())
+            day = func.date(UserActivity.created_at).label("day")
+            result = await self.session.execute(
+                select(day, func.count())
+                .where(
+                    and_(
+                        UserActivity.user_id == user_id,
+                        UserActivity.created_at >= since_date
+                    )
+                )
+                .group_by(day)
+            )
+            return dict(result.all())
+        except Exception as e:
+            logger.error(f"Error getting daily activity counts {user_id}: {e}")
+            return {}
+    
+    async def get_monthly_counts(self, user_id: int, action: str, since: datetime) -> Dict[str, int]:
+        """Количество действий пользователя по месяцам (ключ - "YYYY-MM")"""
+        try:
+            month = func.date_trunc("month", UserActivity.created_at).label("month")
+            result = await self.session.execute(
+                select(month, func.count())
+                .where(
+                    and_(
+                        UserActivity.user_id == user_id,
+                        UserActivity.action == action,
+                        UserActivity.created_at >= since
+                    )
+                )
+                .group_by(month)
+            )
+            return {month_start.strftime("%Y-%m"): count for month_start, count in result.all()}
+        except Exception as e:
+            logger.error(f"Error getting monthly activity counts {user_id}: {e}")
+            return {}
+    
+    async def get_daily_action_counts(self, since: datetime) -> List[Tuple[date, str, int]]:
+        """Количество действий всех пользователей по дням и типам: (day, action, count)"""
+        try:
+            day = func.date(UserActivity.created_at).label("day")
+            result = await self.session.execute(
+                select(day, UserActivity.action, func.count())
+                .where(UserActivity.created_at >= since)
+                .group_by(day, UserActivity.action)
+            )
+            return result.all()
+        except Exception as e:
+            logger.error(f"Error getting daily action counts since {since}: {e}")
+            return []
 
 
 class ServerStatsRepository(BaseRepository):
@@ -370,6 +822,14 @@ class ServerStatsRepository(BaseRepository):
         except Exception as e:
             logger.error(f"Error recording server stats: {e}")
     
+    async def record_stats_bulk(self, rows: List[Dict[str, Any]]) -> int:
+        """Записать статистику нескольких серверов одним INSERT"""
+        if not rows:
+            return 0
+        
+        await self.session.execute(insert(ServerStats), rows)
+        return len(rows)
+    
     async def get_server_stats(self, server_id: int, hours: int = 24) -> List[ServerStats]:
         """Получить статистику сервера за период"""
         try:
@@ -388,6 +848,59 @@ class ServerStatsRepository(BaseRepository):
         except Exception as e:
             logger.error(f"Error getting server stats {server_id}: {e}")
             return []
+    
+    async def stream_server_stats(
+        self,
+        server_id: int,
+        hours: int = 24,
+        batch_size: int = 1000
+    ) -> AsyncIterator[ServerStats]:
+        """Потоково получить статистику сервера за период (серверный курсор, пачками)"""
+        since_date = datetime.utcnow() - timedelta(hours=hours)
+        result = await self.session.stream_scalars(
+            select(ServerStats)
+            .where(
+                and_(
+                    ServerStats.server_id == server_id,
+                    ServerStats.recorded_at >= since_date
+                )
+            )
+            .order_by(ServerStats.recorded_at.asc())
+            .execution_options(yield_per=batch_size)
+        )
+        async for stat in result:
+            yield stat
+    
+    async def get_aggregated(self, server_id: int, days: int = 7) -> List[Any]:
+        """Дневные агрегаты статистики сервера
+        (day, data_points, cpu_sum, memory_sum, disk_sum, connections_sum, peak_connections, peak_cpu)"""
+        try:
+            since_date = datetime.utcnow() - timedelta(days=days)
+            day = func.date_trunc("day", ServerStats.recorded_at)
+            result = await self.session.execute(
+                select(
+                    day.label("day"),
+                    func.count().label("data_points"),
+                    func.sum(ServerStats.cpu_usage).label("cpu_sum"),
+                    func.sum(ServerStats.memory_usage).label("memory_sum"),
+                    func.sum(ServerStats.disk_usage).label("disk_sum"),
+                    func.sum(ServerStats.active_connections).label("connections_sum"),
+                    func.max(ServerStats.active_connections).label("peak_connections"),
+                    func.max(ServerStats.cpu_usage).label("peak_cpu")
+                )
+                .where(
+                    and_(
+                        ServerStats.server_id == server_id,
+                        ServerStats.recorded_at >= since_date
+                    )
+                )
+                .group_by(day)
+                .order_by(day)
+            )
+            return result.all()
+        except Exception as e:
+            logger.error(f"Error aggregating server stats {server_id}: {e}")
+            return []
 
 
 class SystemSettingsRepository(BaseRepository):
@@ -404,6 +917,16 @@ class SystemSettingsRepository(BaseRepository):
             logger.error(f"Error getting setting {key}: {e}")
             return None
     
+    async def get_cached_setting(self, key: str) -> Optional[str]:
+        """Получить настройку из кеша процесса (TTL SETTINGS_CACHE_TTL)"""
+        cached = _SETTINGS_CACHE.get(key)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        
+        value = await self.get_setting(key)
+        _SETTINGS_CACHE[key] = (time.monotonic() + SETTINGS_CACHE_TTL, value)
+        return value
+    
     async def set_setting(self, key: str, value: str, description: Optional[str] = None, category: str = "general") -> bool:
         """Установить настройку"""
         try:
@@ -431,6 +954,7 @@ class SystemSettingsRepository(BaseRepository):
                 self.session.add(setting)
             
             await self.session.flush()
+            invalidate_settings_cache(key)
             return True
         except Exception as e:
             logger.error(f"Error setting {key}: {e}")
@@ -453,19 +977,52 @@ class RepositoryManager:
     
     def __init__(self, session: AsyncSession):
         self.session = session
-        
-        # Инициализация всех репозиториев
-        self.users = UserRepository(session)
-        self.servers = ServerRepository(session)
-        self.subscription_plans = SubscriptionPlanRepository(session)
-        self.subscriptions = SubscriptionRepository(session)
-        self.vpn_configs = VpnConfigRepository(session)
-        self.payments = PaymentRepository(session)
-        self.support_tickets = SupportTicketRepository(session)
-        self.support_messages = SupportMessageRepository(session)
-        self.user_activities = UserActivityRepository(session)
-        self.server_stats = ServerStatsRepository(session)
-        self.system_settings = SystemSettingsRepository(session)
+    
+    # Репозитории создаются при первом обращении: большинству
+    # обработчиков нужны один-два из них
+    @cached_property
+    def users(self) -> "UserRepository":
+        return UserRepository(self.session)
+    
+    @cached_property
+    def servers(self) -> "ServerRepository":
+        return ServerRepository(self.session)
+    
+    @cached_property
+    def subscription_plans(self) -> "SubscriptionPlanRepository":
+        return SubscriptionPlanRepository(self.session)
+    
+    @cached_property
+    def subscriptions(self) -> "SubscriptionRepository":
+        return SubscriptionRepository(self.session)
+    
+    @cached_property
+    def vpn_configs(self) -> "VpnConfigRepository":
+        return VpnConfigRepository(self.session)
+    
+    @cached_property
+    def payments(self) -> "PaymentRepository":
+        return PaymentRepository(self.session)
+    
+    @cached_property
+    def support_tickets(self) -> "SupportTicketRepository":
+        return SupportTicketRepository(self.session)
+    
+    @cached_property
+    def support_messages(self) -> "SupportMessageRepository":
+        return SupportMessageRepository(self.session)
+    
+    @cached_property
+    def user_activities(self) -> "UserActivityRepository":
+        return UserActivityRepository(self.session)
+    
+    @cached_property
+    def server_stats(self) -> "ServerStatsRepository":
+        return ServerStatsRepository(self.session)
+    
+    @cached_property
+    def system_settings(self) -> "SystemSettingsRepository":
+        return SystemSettingsRepository(self.session)
     
     async def commit(self):
         """Зафиксировать все изменения"""
@@ -548,6 +1105,36 @@ class RepositoryManager:
             logger.error(f"Error getting active users count: {e}")
             return 0
     
+    async def get_users_counts(self, new_since: datetime) -> Dict[str, int]:
+        """Счетчики пользователей одним проходом по таблице (COUNT ... FILTER)"""
+        try:
+            result = await self.session.execute(
+                select(
+                    func.count().label("total_users"),
+                    func.count().filter(
+                        and_(User.is_active == True, User.is_banned == False)
+                    ).label("active_users"),
+                    func.count().filter(User.is_banned == True).label("banned_users"),
+                    func.count().filter(User.role == UserRole.ADMIN).label("admins"),
+                    func.count().filter(User.created_at >= new_since).label("new_today")
+                ).select_from(User)
+            )
+            return dict(result.one()._mapping)
+        except Exception as e:
+            logger.error(f"Error getting users counts: {e}")
+            return {}
+    
+    async def get_id_and_role_by_telegram_id(self, telegram_id: int) -> Optional[Tuple[int, UserRole]]:
+        """Получить только ID и роль пользователя по Telegram ID"""
+        try:
+            result = await self.session.execute(
+                select(User.id, User.role).where(User.telegram_id == telegram_id)
+            )
+            return result.one_or_none()
+        except Exception as e:
+            logger.error(f"Error getting role by telegram_id {telegram_id}: {e}")
+            return None
+    
     async def get_users_by_country(self, country_code: str) -> List[User]:
         """Получить пользователей по коду страны"""
         try:
@@ -566,11 +1153,7 @@ class ServerRepository(BaseRepository):
     async def get_all_active(self) -> List[Server]:
         """Получить все активные серверы"""
         try:
-            result = await self.session.execute(
-                select(Server).where(
-                    and_(Server.is_active == True, Server.is_maintenance == False)
-                ).order_by(Server.country, Server.name)
-            )
+            result = await self.session.execute(_ACTIVE_SERVERS_STMT)
             return result.scalars().all()
         except Exception as e:
             logger.error(f"Error getting active servers: {e}")
@@ -580,29 +1163,112 @@ class ServerRepository(BaseRepository):
         """Получить сервер по ID"""
         try:
             result = await self.session.execute(
-                select(Server).where(Server.id == server_id)
+                _SERVER_BY_ID_STMT, {"server_id": server_id}
             )
             return result.scalar_one_or_none()
         except Exception as e:
             logger.error(f"Error getting server by id {server_id}: {e}")
             return None
     
+    async def get_by_ids(self, server_ids: Sequence[int]) -> List[Server]:
+        """Получить серверы по списку ID в порядке списка"""
+        if not server_ids:
+            return []
+        try:
+            result = await self.session.execute(
+                select(Server).where(Server.id.in_(server_ids))
+            )
+            servers = {server.id: server for server in result.scalars()}
+            return [servers[server_id] for server_id in server_ids if server_id in servers]
+        except Exception as e:
+            logger.error(f"Error getting servers by ids: {e}")
+            return []
+    
     async def get_by_protocol(self, protocol: VpnProtocol) -> List[Server]:
         """Получить серверы, поддерживающие протокол"""
         try:
+            result = await self.session.execute(_SERVERS_BY_PROTOCOL_STMTS[protocol])
+            return result.scalars().all()
+        except Exception as e:
+            logger.error(f"Error getting servers by protocol {protocol}: {e}")
+            return []
+    
+    async def get_candidates(
+        self,
+        protocol: Optional[VpnProtocol] = None,
+        country_codes: Optional[List[str]] = None,
+        exclude_ids: Optional[List[int]] = None,
+        max_load: Optional[float] = None,
+        order_by_load: bool = False,
+        limit: Optional[int] = None
+    ) -> List[Server]:
+        """Получить доступные серверы с фильтрацией на стороне БД"""
+        try:
+            query = select(Server).where(
+                and_(Server.is_active == True, Server.is_maintenance == False)
+            )
+            
+            if protocol:
+                query = query.where(Server.supported_protocols.contains([protocol.value]))
+            if country_codes:
+                query = query.where(Server.country_code.in_(country_codes))
+            if exclude_ids:
+                query = query.where(Server.id.notin_(exclude_ids))
+            if max_load is not None:
+                query = query.where(Server.load < max_load)
+            
+            if order_by_load:
+                query = query.order_by(Server.load, Server.id)
+            else:
+                query = query.order_by(Server.country, Server.name)
+            if limit:
+                query = query.limit(limit)
+            
             result = await self.session.execute(
-                select(Server).where(
-                    and_(
-                        Server.is_active == True,
-                        Server.supported_protocols.contains([protocol.value])
-                    )
-                )
+                query.execution_options(compiled_cache=_SERVER_COMPILED_CACHE)
             )
             return result.scalars().all()
         except Exception as e:
-            logger.error(f"Error getting servers by protocol {protocol}: {e}")
+            logger.error(f"Error getting candidate servers: {e}")
             return []
     
+    async def select_best(
+        self,
+        protocol: Optional[VpnProtocol] = None,
+        preferred_countries: Optional[Sequence[str]] = None
+    ) -> Optional[Server]:
+        """
+        Выбрать наименее заполненный сервер одним запросом
+        
+        Серверы из preferred_countries идут первыми в порядке списка,
+        внутри страны - по доле занятых мест
+        """
+        try:
+            query = select(Server).where(
+                and_(Server.is_active == True, Server.is_maintenance == False)
+            )
+            if protocol:
+                query = query.where(Server.supported_protocols.contains([protocol.value]))
+            
+            user_ratio = Server.current_users * 1.0 / func.nullif(Server.max_users, 0)
+            if preferred_countries:
+                country_rank = case(
+                    {country: rank for rank, country in enumerate(preferred_countries)},
+                    value=Server.country_code,
+                    else_=len(preferred_countries)
+                )
+                query = query.order_by(country_rank, user_ratio.asc().nulls_last())
+            else:
+                query = query.order_by(user_ratio.asc().nulls_last())
+            
+            result = await self.session.execute(
+                query.limit(1).execution_options(compiled_cache=_SERVER_COMPILED_CACHE)
+            )
+            return result.scalars().first()
+        except Exception as e:
+            logger.error(f"Error selecting best server: {e}")
+            return None
+    
     async def get_best_server(self, country_code: Optional[str] = None) -> Optional[Server]:
         """Получить лучший сервер (с наименьшей нагрузкой)"""
         try:
@@ -638,6 +1304,23 @@ class ServerRepository(BaseRepository):
         except Exception as e:
             logger.error(f"Error updating server stats {server_id}: {e}")
             return False
+    
+    async def bulk_update_stats(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        Обновить статистику нескольких серверов одним запросом
+        
+        Каждая строка содержит id сервера и обновляемые поля
+        (bulk UPDATE по первичному ключу)
+        """
+        if not rows:
+            return 0
+        
+        now = datetime.utcnow()
+        await self.session.execute(
+            update(Server),
+            [{"updated_at": now, **row} for row in rows]
+        )
+        return len(rows)
 
 
 class SubscriptionPlanRepository(BaseRepository):
@@ -667,6 +1350,33 @@ class SubscriptionPlanRepository(BaseRepository):
             logger.error(f"Error getting plan by id {plan_id}: {e}")
             return None
     
+    async def get_cached(self, plan_id: int) -> Optional[PlanInfo]:
+        """
+        Получить снимок тарифа из кеша процесса (TTL PLAN_CACHE_TTL)
+        
+        Читаются только колонки - selectin-коллекция подписок плана не грузится
+        """
+        cached = _PLAN_CACHE.get(plan_id)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        
+        try:
+            result = await self.session.execute(
+                select(*(getattr(SubscriptionPlan, field) for field in PlanInfo._fields))
+                .where(SubscriptionPlan.id == plan_id)
+            )
+            row = result.first()
+        except Exception as e:
+            logger.error(f"Error getting plan by id {plan_id}: {e}")
+            return None
+        
+        if row is None:
+            return None
+        
+        plan = PlanInfo(*row)
+        _PLAN_CACHE[plan_id] = (time.monotonic() + PLAN_CACHE_TTL, plan)
+        return plan
+    
     async def get_trial_plan(self) -> Optional[SubscriptionPlan]:
         """Получить пробный тариф"""
         try:
@@ -687,6 +1397,30 @@ class SubscriptionPlanRepository(BaseRepository):
 class SubscriptionRepository(BaseRepository):
     """Репозиторий для работы с подписками"""
     
+    async def get_by_id(self, subscription_id: int) -> Optional[Subscription]:
+        """Получить подписку по ID вместе с планом, сервером и пользователем"""
+        try:
+            result = await self.session.execute(
+                _SUBSCRIPTION_BY_ID_STMT, {"subscription_id": subscription_id}
+            )
+            return result.scalar_one_or_none()
+        except Exception as e:
+            logger.error(f"Error getting subscription by id {subscription_id}: {e}")
+            return None
+    
+    async def update(self, subscription_id: int, **values) -> bool:
+        """Обновить поля подписки"""
+        try:
+            result = await self.session.execute(
+                update(Subscription)
+                .where(Subscription.id == subscription_id)
+                .values(updated_at=datetime.utcnow(), **values)
+            )
+            return result.rowcount > 0
+        except Exception as e:
+            logger.error(f"Error updating subscription {subscription_id}: {e}")
+            return False
+    
     async def get_user_subscriptions(self, user_id: int) -> List[Subscription]:
         """Получить подписки пользователя"""
         try:
@@ -694,9 +1428,13 @@ class SubscriptionRepository(BaseRepository):
                 select(Subscription)
                 .where(Subscription.user_id == user_id)
                 .options(
-                    selectinload(Subscription.server),
-                    selectinload(Subscription.plan),
+                    # Сервер и план - тем же запросом, без каскада их selectin-коллекций
+                    # (все подписки сервера/плана, конфигурации, история статистики)
+                    joinedload(Subscription.server).lazyload("*"),
+                    joinedload(Subscription.plan).lazyload("*"),
                     selectinload(Subscription.vpn_configs)
+                    .joinedload(VpnConfig.server)
+                    .lazyload("*")
                 )
                 .order_by(Subscription.created_at.desc())
             )
@@ -705,23 +1443,51 @@ class SubscriptionRepository(BaseRepository):
             logger.error(f"Error getting user subscriptions {user_id}: {e}")
             return []
     
+    async def get_user_server_stats(self, user_id: int) -> List[Tuple]:
+        """
+        Подписки и трафик конфигураций пользователя по серверам
+        
+        Returns:
+            List[Tuple]: (server_name, subscriptions, traffic_gb)
+        """
+        try:
+            result = await self.session.execute(
+                select(
+                    Server.name,
+                    func.count(Subscription.id.distinct()),
+                    func.coalesce(func.sum(VpnConfig.total_traffic_gb), 0)
+                )
+                .select_from(Subscription)
+                .join(Server, Subscription.server_id == Server.id)
+                .outerjoin(VpnConfig, VpnConfig.subscription_id == Subscription.id)
+                .where(Subscription.user_id == user_id)
+                .group_by(Server.name)
+            )
+            return result.all()
+        except Exception as e:
+            logger.error(f"Error getting server stats for user {user_id}: {e}")
+            return []
+    
+    async def get_user_protocol_counts(self, user_id: int) -> Dict[VpnProtocol, int]:
+        """Количество конфигураций пользователя по протоколам"""
+        try:
+            result = await self.session.execute(
+                select(VpnConfig.protocol, func.count())
+                .join(Subscription, VpnConfig.subscription_id == Subscription.id)
+                .where(Subscription.user_id == user_id)
+                .group_by(VpnConfig.protocol)
+            )
+            return dict(result.all())
+        except Exception as e:
+            logger.error(f"Error getting protocol stats for user {user_id}: {e}")
+            return {}
+    
     async def get_active_subscription(self, user_id: int) -> Optional[Subscription]:
         """Получить активную подписку пользователя"""
         try:
             result = await self.session.execute(
-                select(Subscription)
-                .where(
-                    and_(
-                        Subscription.user_id == user_id,
-                        Subscription.status == SubscriptionStatus.ACTIVE,
-                        Subscription.expires_at > datetime.utcnow()
-                    )
-                )
-                .options(
-                    selectinload(Subscription.server),
-                    selectinload(Subscription.plan),
-                    selectinload(Subscription.vpn_configs)
-                )
+                _ACTIVE_SUBSCRIPTION_STMT,
+                {"user_id": user_id, "now": datetime.utcnow()}
             )
             return result.scalars().first()
         except Exception as e:
@@ -745,29 +1511,155 @@ class SubscriptionRepository(BaseRepository):
         """Обновить статус подписки"""
         try:
             result = await self.session.execute(
-                update(Subscription)
-                .where(Subscription.id == subscription_id)
-                .values(status=status, updated_at=datetime.utcnow())
+                _SUBSCRIPTION_STATUS_STMT,
+                {"subscription_id": subscription_id, "new_status": status, "now": datetime.utcnow()}
             )
             return result.rowcount > 0
         except Exception as e:
             logger.error(f"Error updating subscription status {subscription_id}: {e}")
             return False
     
-    async def get_expiring_subscriptions(self, hours: int = 24) -> List[Subscription]:
-        """Получить подписки, истекающие через указанное количество часов"""
+    async def update_with_activity(
+        self,
+        subscription_id: int,
+        action: str,
+        details: Optional[Dict[str, Any]] = None,
+        **values
+    ) -> Optional[int]:
+        """Обновить подписку и записать активность одним запросом (ID пользователя или None)"""
+        return await self._update_with_activity(
+            Subscription, subscription_id, Subscription.user_id, action, details, values
+        )
+    
+    async def increment_traffic_bulk(self, deltas: Dict[int, float]) -> List[Tuple]:
+        """
+        Атомарно увеличить использованный трафик пачки подписок
+        
+        UPDATE subscriptions ... FROM (VALUES (id, delta_gb), ...)
+        
+        Returns:
+            List[Tuple]: (id, user_id, traffic_used_gb, traffic_limit_gb) обновленных подписок
+        """
+        if not deltas:
+            return []
+        
+        traffic = (
+            values_clause(column("id", Integer), column("delta_gb", Float), name="traffic")
+            .data(list(deltas.items()))
+        )
+        result = await self.session.execute(
+            update(Subscription)
+            .where(Subscription.id == traffic.c.id)
+            .values(
+                traffic_used_gb=Subscription.traffic_used_gb + traffic.c.delta_gb,
+                updated_at=datetime.utcnow()
+            )
+            .returning(
+                Subscription.id,
+                Subscription.user_id,
+                Subscription.traffic_used_gb,
+                Subscription.traffic_limit_gb
+            )
+        )
+        return result.all()
+    
+    async def suspend_many(self, subscription_ids: List[int]) -> List[Tuple]:
+        """
+        Приостановить активные подписки одним UPDATE
+        
+        Returns:
+            List[Tuple]: (id, user_id) приостановленных подписок
+        """
+        if not subscription_ids:
+            return []
+        
+        result = await self.session.execute(
+            update(Subscription)
+            .where(
+                and_(
+                    Subscription.id.in_(subscription_ids),
+                    Subscription.status == SubscriptionStatus.ACTIVE
+                )
+            )
+            .values(status=SubscriptionStatus.SUSPENDED, updated_at=datetime.utcnow())
+            .returning(Subscription.id, Subscription.user_id)
+        )
+        return result.all()
+    
+    async def refresh_and_fetch_active(self, user_id: int) -> Optional[Tuple]:
+        """
+        Актуализировать статус текущей подписки пользователя и вернуть его
+        
+        Истекшая активная подписка переводится в EXPIRED тем же UPDATE,
+        которым читаются статус и дата окончания.
+        
+        Returns:
+            Optional[Tuple]: (status, expires_at) или None
+        """
         try:
-            expiry_time = datetime.utcnow() + timedelta(hours=hours)
+            now = datetime.utcnow()
+            current_id = (
+                select(Subscription.id)
+                .where(
+                    and_(
+                        Subscription.user_id == user_id,
+                        Subscription.status.in_([SubscriptionStatus.ACTIVE, SubscriptionStatus.EXPIRED])
+                    )
+                )
+                .order_by(Subscription.expires_at.desc().nulls_first())
+                .limit(1)
+                .scalar_subquery()
+            )
             result = await self.session.execute(
-                select(Subscription)
+                update(Subscription)
+                .where(Subscription.id == current_id)
+                .values(
+                    status=case(
+                        (
+                            and_(
+                                Subscription.status == SubscriptionStatus.ACTIVE,
+                                Subscription.expires_at <= now
+                            ),
+                            SubscriptionStatus.EXPIRED
+                        ),
+                        else_=Subscription.status
+                    )
+                )
+                .returning(Subscription.status, Subscription.expires_at)
+            )
+            return result.first()
+        except Exception as e:
+            logger.error(f"Error refreshing active subscription for user {user_id}: {e}")
+            return None
+    
+    async def expire_due(self) -> int:
+        """Перевести все истекшие активные подписки в EXPIRED одним UPDATE"""
+        try:
+            # expires_at хранится naive UTC: сравниваем с utcnow(), а не с now()
+            # сервера БД, который зависит от TimeZone сессии
+            now = datetime.utcnow()
+            result = await self.session.execute(
+                update(Subscription)
                 .where(
                     and_(
                         Subscription.status == SubscriptionStatus.ACTIVE,
-                        Subscription.expires_at <= expiry_time,
-                        Subscription.expires_at > datetime.utcnow()
+                        Subscription.expires_at <= now
                     )
                 )
-                .options(selectinload(Subscription.user))
+                .values(status=SubscriptionStatus.EXPIRED, updated_at=now)
+            )
+            return result.rowcount
+        except Exception as e:
+            logger.error(f"Error expiring due subscriptions: {e}")
+            return 0
+    
+    async def get_expiring_subscriptions(self, hours: int = 24) -> List[Subscription]:
+        """Получить подписки, истекающие через указанное количество часов"""
+        try:
+            now = datetime.utcnow()
+            result = await self.session.execute(
+                _EXPIRING_SUBSCRIPTIONS_STMT,
+                {"now": now, "expiry_time": now + timedelta(hours=hours)}
             )
             return result.scalars().all()
         except Exception as e:
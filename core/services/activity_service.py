@@ -0,0 +1,318 @@
+"""
+Буферизованная запись активности пользователей, истории серверов и трафика
+"""
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Optional, List, Dict, Any
+from datetime import datetime
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from loguru import logger
+
+from core.database.repositories import RepositoryManager
+from config.database import run_in_own_session
+
+
+# Временные сбои БД и пула - пачку стоит повторить; остальные ошибки
+# (IntegrityError, DataError, ошибки сериализации) повтор не исправит
+_RETRYABLE_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError, ConnectionError, asyncio.TimeoutError)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Можно ли повторить запись после ошибки"""
+    if isinstance(error, _RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class BulkWriteBuffer(ABC):
+    """
+    Буфер отложенной пакетной записи
+    
+    Строки копятся в памяти и пишутся одним INSERT в отдельной сессии:
+    по достижении max_batch сразу, иначе через flush_delay секунд после
+    первой строки в пачке. Ожидающая задача сброса - не более одной.
+    
+    При временном сбое БД пачка возвращается в буфер и повторяется;
+    пачка с ошибкой данных делится пополам, пока не останутся
+    отдельные плохие строки - они отбрасываются с записью в лог.
+    В буфере хранится не больше max_pending строк.
+    """
+    
+    name = "rows"
+    
+    # Повтор записи после ошибки: задержка удваивается до MAX_RETRY_DELAY
+    MAX_RETRY_DELAY = 60.0
+    
+    def __init__(self, max_batch: int = 100, flush_delay: float = 1.0, max_pending: Optional[int] = None):
+        self.max_batch = max_batch
+        self.flush_delay = flush_delay
+        self.max_pending = max_pending or max_batch * 100
+        self._pending = self._new_batch()
+        self._flush_task: Optional[asyncio.Task] = None  # Ждущая своего часа задача сброса
+        self._flush_now = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._retry_delay = 0.0
+    
+    def _new_batch(self) -> Any:
+        """Пустая пачка"""
+        return []
+    
+    def _restore(self, batch: Any):
+        """Вернуть незаписанную пачку в буфер перед строками, пришедшими позже"""
+        self._pending[:0] = batch
+    
+    def _split(self, batch: Any) -> List[Any]:
+        """Разделить пачку пополам"""
+        middle = len(batch) // 2
+        return [batch[:middle], batch[middle:]]
+    
+    def _trim(self):
+        """Отбросить самые старые строки сверх max_pending"""
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            del self._pending[:overflow]
+            logger.error("Buffer of {} is full, dropped {} oldest rows", self.name, overflow)
+    
+    def _enqueue_row(self, row: Dict[str, Any]):
+        """Поставить строку в очередь и запланировать запись"""
+        self._pending.append(row)
+        self._trim()
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        """Запланировать запись по размеру пачки или по таймеру"""
+        self._schedule(self._retry_delay or self.flush_delay)
+        # Полная пачка пишется сразу, но не в паузе между повторами после ошибки
+        if len(self._pending) >= self.max_batch and not self._retry_delay:
+            self._flush_now.set()
+    
+    def _schedule(self, delay: float):
+        """Запланировать сброс буфера, если он еще не запланирован"""
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Вне event loop - запишем при следующем flush()
+        
+        self._flush_task = loop.create_task(self._flush_later(delay))
+    
+    async def _flush_later(self, delay: float):
+        """Сбросить буфер после задержки или по сигналу о полной пачке"""
+        try:
+            await asyncio.wait_for(self._flush_now.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        
+        # С этого момента строки, пришедшие во время записи, планируют новый сброс
+        self._flush_now.clear()
+        self._flush_task = None
+        await self.flush()
+    
+    @abstractmethod
+    async def _write(self, repos: RepositoryManager, batch: Any) -> int:
+        """Записать пачку строк"""
+        pass
+    
+    async def flush(self) -> int:
+        """
+        Записать накопленные строки
+        
+        Returns:
+            int: Количество записанных строк
+        """
+        async with self._lock:
+            if not self._pending:
+                return 0
+            
+            parts = [self._pending]
+            self._pending = self._new_batch()
+            written = 0
+            
+            while parts:
+                part = parts.pop(0)
+                try:
+                    written += await run_in_own_session(
+                        lambda s: self._write(RepositoryManager(s), part),
+                        commit=True
+                    )
+                except Exception as e:
+                    if _is_retryable(e):
+                        # Незаписанное не теряем: возвращаем в буфер в прежнем порядке
+                        # и повторяем с нарастающей задержкой
+                        unwritten = [part, *parts]
+                        for batch in reversed(unwritten):
+                            self._restore(batch)
+                        self._trim()
+                        self._retry_delay = min(self._retry_delay * 2 or self.flush_delay, self.MAX_RETRY_DELAY)
+                        logger.error(
+                            "Error flushing {} {}, retrying in {}s: {}",
+                            sum(map(len, unwritten)), self.name, self._retry_delay, e
+                        )
+                        self._schedule(self._retry_delay)
+                        return written
+                    
+                    if len(part) > 1:
+                        # Ищем плохие строки делением пачки, остальные пишем
+                        parts[0:0] = self._split(part)
+                    else:
+                        logger.error("Dropping {} that cannot be written: {!r}: {}", self.name, part, e)
+            
+            self._retry_delay = 0.0
+            return written
+    
+    async def close(self):
+        """Дописать оставшиеся строки при остановке"""
+        # Отменяем только ждущую задачу: идущая запись держит _lock,
+        # и flush() ниже дождется ее завершения
+        task, self._flush_task = self._flush_task, None
+        if task and not task.done():
+            task.cancel()
+        await self.flush()
+
+
+class ActivityLogBuffer(BulkWriteBuffer):
+    """Буфер записей активности пользователей"""
+    
+    name = "user activities"
+    
+    def enqueue(self, user_id: int, action: str, details: Optional[Dict[str, Any]] = None, **kwargs):
+        """
+        Поставить запись активности в очередь
+        
+        Args:
+            user_id: ID пользователя
+            action: Действие
+            details: Детали действия
+        """
+        self._enqueue_row({
+            "user_id": user_id,
+            "action": action,
+            "details": details,
+            "created_at": datetime.utcnow(),
+            **kwargs
+        })
+    
+    async def _write(self, repos: RepositoryManager, batch: List[Dict[str, Any]]) -> int:
+        return await repos.user_activities.log_activities_bulk(batch)
+
+
+class ServerStatsHistoryBuffer(BulkWriteBuffer):
+    """
+    Буфер истории статистики серверов
+    
+    Текущие значения в servers пишутся сразу, а история в server_stats -
+    отложенно и пачками, вне коммита обновления статистики.
+    """
+    
+    name = "server stats rows"
+    
+    def enqueue(self, row: Dict[str, Any]):
+        """
+        Поставить строку истории в очередь
+        
+        Args:
+            row: Поля ServerStats (server_id, cpu_usage, ...)
+        """
+        self._enqueue_row({"recorded_at": datetime.utcnow(), **row})
+    
+    async def _write(self, repos: RepositoryManager, batch: List[Dict[str, Any]]) -> int:
+        return await repos.server_stats.record_stats_bulk(batch)
+
+
+class TrafficUsageBuffer(BulkWriteBuffer):
+    """
+    Агрегатор отчетов об использованном трафике
+    
+    Приращения по одной подписке складываются в памяти и пишутся одним
+    UPDATE на пачку; подписки, превысившие лимит, приостанавливаются
+    в той же транзакции.
+    """
+    
+    name = "traffic deltas"
+    
+    def _new_batch(self) -> Dict[int, float]:
+        return {}
+    
+    def _restore(self, batch: Dict[int, float]):
+        # Транзакция пачки откатилась целиком: складываем приращения обратно
+        for subscription_id, traffic_gb in batch.items():
+            self._pending[subscription_id] = self._pending.get(subscription_id, 0.0) + traffic_gb
+    
+    def _split(self, batch: Dict[int, float]) -> List[Dict[int, float]]:
+        items = list(batch.items())
+        middle = len(items) // 2
+        return [dict(items[:middle]), dict(items[middle:])]
+    
+    def _trim(self):
+        # Ключ - подписка: размер ограничен числом подписок, а отброшенные
+        # приращения означали бы бесплатный трафик
+        pass
+    
+    def add(self, subscription_id: int, traffic_gb: float):
+        """
+        Учесть приращение трафика подписки
+        
+        Args:
+            subscription_id: ID подписки
+            traffic_gb: Использованный трафик в ГБ
+        """
+        self._pending[subscription_id] = self._pending.get(subscription_id, 0.0) + traffic_gb
+        self._schedule_flush()
+    
+    async def _write(self, repos: RepositoryManager, batch: Dict[int, float]) -> int:
+        updated = await repos.subscriptions.increment_traffic_bulk(batch)
+        
+        over_limit = {
+            row.id: row for row in updated
+            if row.traffic_limit_gb and row.traffic_used_gb >= row.traffic_limit_gb
+        }
+        if over_limit:
+            suspended = await repos.subscriptions.suspend_many(list(over_limit))
+            now = datetime.utcnow()
+            activities = []
+            
+            for subscription_id, user_id in suspended:
+                row = over_limit[subscription_id]
+                activities.append({
+                    "user_id": user_id,
+                    "action": "subscription_suspended",
+                    "details": {
+                        "subscription_id": subscription_id,
+                        "reason": "traffic_limit_exceeded",
+                        "admin_id": None,
+                        "suspended_at": now
+                    },
+                    "created_at": now
+                })
+                activities.append({
+                    "user_id": user_id,
+                    "action": "traffic_limit_exceeded",
+                    "details": {
+                        "subscription_id": subscription_id,
+                        "traffic_used": float(row.traffic_used_gb),
+                        "traffic_limit": row.traffic_limit_gb
+                    },
+                    "created_at": now
+                })
+            
+            await repos.user_activities.log_activities_bulk(activities)
+            if suspended:
+                logger.info("Suspended {} subscriptions over traffic limit", len(suspended))
+        
+        return len(updated)
+
+
+# Глобальные буферы
+activity_log_buffer = ActivityLogBuffer()
+server_stats_history_buffer = ServerStatsHistoryBuffer(max_batch=500)
+traffic_usage_buffer = TrafficUsageBuffer(max_batch=1000, flush_delay=5.0)
+
+
+async def close_buffers():
+    """Дописать все буферы при остановке"""
+    await activity_log_buffer.close()
+    await server_stats_history_buffer.close()
+    await traffic_usage_buffer.close()
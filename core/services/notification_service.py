@@ -123,7 +123,7 @@ class NotificationService:
         try:
             # Проверяем rate limiting
             if not await self._check_rate_limit(user_id, notification_type, priority):
-                logger.info(f"Rate limit hit for user {user_id}, notification {notification_type.value}")
+                logger.debug("Rate limit hit for user {}, notification {}", user_id, notification_type.value)
                 return False
             
             # Получаем пользователя
@@ -134,7 +134,7 @@ class NotificationService:
             
             # Проверяем настройки уведомлений пользователя
             if not await self._check_user_preferences(user, notification_type):
-                logger.info(f"User {user_id} disabled notifications for {notification_type.value}")
+                logger.debug("User {} disabled notifications for {}", user_id, notification_type.value)
                 return False
             
             # Используем каналы по умолчанию если не указаны
@@ -433,7 +433,7 @@ class NotificationService:
             # В реальной реализации здесь был бы вызов Telegram Bot API
             # Пока просто логируем
             
-            logger.info(f"Telegram notification to {user.telegram_id}: {message[:100]}...")
+            logger.debug("Telegram notification to {}: {:.100}...", user.telegram_id, message)
             
             # Эмуляция отправки
             await asyncio.sleep(0.01)  # Имитация network delay
@@ -455,7 +455,7 @@ class NotificationService:
         """Отправить Email уведомление"""
         try:
             # В реальной реализации здесь была бы отправка email
-            logger.info(f"Email notification to {user.telegram_id}: {title}")
+            logger.debug("Email notification to {}: {}", user.telegram_id, title)
             
             # Эмуляция отправки
             await asyncio.sleep(0.02)
@@ -652,28 +652,28 @@ class SubscriptionNotificationService:
     async def check_and_notify_expiring_subscriptions(self) -> int:
         """Проверить и уведомить о истекающих подписках"""
         try:
+            from core.services.subscription_service import SubscriptionService
+            
             # Проверяем подписки, истекающие в ближайшие дни
             notification_days = [1, 3, 7]  # За сколько дней уведомлять
             notified_count = 0
+            subscription_service = SubscriptionService(self.session)
             
             for days in notification_days:
-                expiring_subscriptions = await self.repos.subscriptions.get_expiring_subscriptions(
-                    hours=days * 24
-                )
-                
-                for subscription in expiring_subscriptions:
+                # Уведомления рассылаются параллельно, каждое в своей сессии
+                async def notify(session: AsyncSession, subscription: Subscription, days: int = days) -> bool:
+                    notifier = SubscriptionNotificationService(session)
+                    
                     # Проверяем, не отправляли ли уже уведомление
-                    last_notification = await self._get_last_expiry_notification(
-                        subscription.id, days
-                    )
+                    if await notifier._get_last_expiry_notification(subscription.id, days):
+                        return False
                     
-                    if not last_notification:
-                        success = await self.notify_subscription_expiring(
-                            subscription.id, days
-                        )
-                        if success:
-                            notified_count += 1
-                            await self._record_expiry_notification(subscription.id, days)
+                    success = await notifier.notify_subscription_expiring(subscription.id, days)
+                    if success:
+                        await notifier._record_expiry_notification(subscription.id, days)
+                    return success
+                
+                notified_count += await subscription_service.process_expiring(notify, hours=days * 24)
             
             if notified_count > 0:
                 logger.info(f"Sent {notified_count} expiry notifications")
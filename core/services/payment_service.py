@@ -7,10 +7,13 @@ import uuid
 import hmac
 import hashlib
 import json
+import time
+from collections import Counter, defaultdict
 from decimal import Decimal
 from typing import Optional, List, Dict, Any, Tuple
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
 from loguru import logger
 
 from core.database.models import (
@@ -25,6 +28,36 @@ from core.exceptions.custom_exceptions import (
 )
 from core.utils.crypto import crypto_manager, hash_config_data
 from config.settings import settings
+from config.database import run_in_own_session
+
+
+def _now() -> datetime:
+    """Текущее время UTC без tzinfo (колонки DateTime в БД naive)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# Частые Decimal-константы
+_ZERO = Decimal(0)
+_SUSPICIOUS_AMOUNT = Decimal("5000.00")
+
+# Окна лимитов платежей
+_ONE_HOUR = timedelta(hours=1)
+_ONE_DAY = timedelta(days=1)
+
+# Члены Enum - синглтоны, в циклах сравниваем через is
+_STATUS_COMPLETED = PaymentStatus.COMPLETED
+
+# Ожидаемые ошибки проверок и аналитики: БД и некорректные данные
+_DATA_ERRORS = (SQLAlchemyError, ValueError, TypeError, ArithmeticError)
+
+
+def _to_decimal(value: Any) -> Decimal:
+    """Привести значение к Decimal без лишнего str() для Decimal и int"""
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    return Decimal(str(value))
 
 
 class PaymentMethod(enum.Enum):
@@ -38,10 +71,10 @@ class PaymentMethod(enum.Enum):
 class PaymentService:
     """Основной сервис для работы с платежами"""
     
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, repos: Optional[RepositoryManager] = None):
         self.session = session
-        self.repos = RepositoryManager(session)
-        self.user_service = UserService(session)
+        self.repos = repos or RepositoryManager(session)
+        self.user_service = UserService(session, self.repos)
     
     async def create_payment(
         self,
@@ -70,13 +103,13 @@ class PaymentService:
         """
         try:
             # Получаем план подписки
-            plan = await self.repos.subscription_plans.get_by_id(plan_id)
+            plan = await self.repos.subscription_plans.get_cached(plan_id)
             if not plan:
                 raise ValidationError(f"Subscription plan {plan_id} not found")
             
             # Определяем сумму
             if amount is None:
-                amount = Decimal(str(plan.price))
+                amount = _to_decimal(plan.price)
             
             # Создаем платеж
             payment_data = {
@@ -112,6 +145,9 @@ class PaymentService:
             await self.repos.commit()
             logger.info(f"Payment created: {payment.id} for user {user_id}")
             
+            # Новый платеж меняет счетчики лимитов пользователя
+            payment_security_service.invalidate_limits(user_id)
+            
             return payment
             
         except Exception as e:
@@ -191,7 +227,7 @@ class PaymentService:
             await self.repos.payments.update(
                 payment.id,
                 external_payment_id=yoo_payment.id,
-                expires_at=datetime.utcnow() + timedelta(minutes=15)
+                expires_at=_now() + timedelta(minutes=15)
             )
             await self.repos.commit()
             
@@ -226,7 +262,7 @@ class PaymentService:
             await self.repos.payments.update(
                 payment.id,
                 external_payment_id=cryptopay_id,
-                expires_at=datetime.utcnow() + timedelta(hours=1)
+                expires_at=_now() + timedelta(hours=1)
             )
             await self.repos.commit()
             
@@ -271,7 +307,7 @@ class PaymentService:
                 "pay_url": f"https://t.me/CryptoBot?start=pay_{invoice_id}",
                 "mini_app_pay_url": f"https://t.me/CryptoBot/app?startapp=pay_{invoice_id}",
                 "status": "active",
-                "created_at": datetime.utcnow().isoformat()
+                "created_at": _now().isoformat()
             }
             
         except Exception as e:
@@ -389,7 +425,7 @@ class PaymentService:
             update_data = {"status": status}
             
             if status == PaymentStatus.COMPLETED:
-                update_data["paid_at"] = datetime.utcnow()
+                update_data["paid_at"] = _now()
                 
                 # Активируем подписку при успешной оплате
                 await self._activate_subscription_after_payment(payment_id)
@@ -867,7 +903,7 @@ class PaymentValidationService:
         # Проверяем сумму
         if "amount" in payment_data:
             try:
-                amount = Decimal(str(payment_data["amount"]))
+                amount = _to_decimal(payment_data["amount"])
                 if amount <= 0:
                     errors.append("Amount must be positive")
             except (ValueError, TypeError):
@@ -875,8 +911,7 @@ class PaymentValidationService:
         
         # Проверяем валюту
         if "currency" in payment_data:
-            valid_currencies = ["RUB", "USD", "EUR", "BTC", "ETH", "USDT"]
-            if payment_data["currency"] not in valid_currencies:
+            if payment_data["currency"] not in _VALID_CURRENCIES:
                 errors.append(f"Unsupported currency: {payment_data['currency']}")
         
         return errors
@@ -888,7 +923,8 @@ async def create_payment_simple(
     session: AsyncSession,
     user_id: int,
     plan_id: int,
-    payment_method: str = "yookassa"
+    payment_method: str = "yookassa",
+    repos: Optional[RepositoryManager] = None
 ) -> Optional[Payment]:
     """
     Простое создание платежа
@@ -898,12 +934,13 @@ async def create_payment_simple(
         user_id: ID пользователя
         plan_id: ID плана
         payment_method: Метод оплаты
+        repos: Уже созданный менеджер репозиториев сессии (опционально)
         
     Returns:
         Optional[Payment]: Созданный платеж
     """
     try:
-        payment_service = PaymentService(session)
+        payment_service = PaymentService(session, repos)
         method_enum = PaymentMethod(payment_method)
         
         return await payment_service.create_payment(
@@ -919,7 +956,8 @@ async def create_payment_simple(
 async def process_successful_payment(
     session: AsyncSession,
     external_payment_id: str,
-    external_data: Optional[Dict[str, Any]] = None
+    external_data: Optional[Dict[str, Any]] = None,
+    repos: Optional[RepositoryManager] = None
 ) -> bool:
     """
     Обработать успешный платеж по внешнему ID
@@ -928,28 +966,50 @@ async def process_successful_payment(
         session: Сессия базы данных
         external_payment_id: Внешний ID платежа
         external_data: Дополнительные данные
+        repos: Уже созданный менеджер репозиториев сессии (опционально)
         
     Returns:
         bool: Успешность обработки
     """
     try:
-        payment_service = PaymentService(session)
-        repos = RepositoryManager(session)
+        payment_service = PaymentService(session, repos)
+        repos = payment_service.repos
         
-        # Найти платеж
-        payment = await repos.payments.get_by_external_id(external_payment_id)
+        # Поиск и смена статуса одним запросом; повторный webhook ничего не меняет
+        payment = await repos.payments.complete_by_external_id(external_payment_id)
         if not payment:
-            logger.warning(f"Payment not found: {external_payment_id}")
+            logger.warning(f"Payment not found or already completed: {external_payment_id}")
             return False
         
-        # Обновить статус
-        return await payment_service.update_payment_status(
-            payment.id,
-            PaymentStatus.COMPLETED,
-            external_data
+        # Активируем подписку при успешной оплате
+        await payment_service._activate_subscription_after_payment(payment.id)
+        
+        await repos.commit()
+        logger.info(f"Payment {payment.id} status updated to {PaymentStatus.COMPLETED.value}")
+        
+        # Лог только ставится в буфер активности - сессия для него не нужна
+        await UserService(session, repos).log_user_action(
+            user_id=payment.user_id,
+            action="payment_status_updated",
+            details={
+                "payment_id": payment.id,
+                "new_status": PaymentStatus.COMPLETED.value,
+                "external_data": external_data
+            }
         )
         
+        try:
+            await run_in_own_session(
+                lambda s: PaymentNotificationService(s).notify_payment_success(payment.id),
+                commit=True
+            )
+        except Exception as e:
+            logger.error(f"Post-payment notification failed for {payment.id}: {e}")
+        
+        return True
+        
     except Exception as e:
+        await session.rollback()
         logger.error(f"Error processing successful payment: {e}")
         return False
 
@@ -960,6 +1020,12 @@ class PaymentSecurityService:
     def __init__(self):
         self.max_attempts_per_hour = 5
         self.max_amount_per_day = Decimal("10000.00")
+        
+        # Кеш счетчиков лимитов: user_id -> (истекает, платежей за час, сумма за сутки)
+        self.limits_cache_ttl = 5.0
+        self.limits_cache_max_size = 10000
+        self._limits_cache: Dict[int, Tuple[float, int, Decimal]] = {}
+        self._limits_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
     
     async def check_payment_limits(
         self,
@@ -979,29 +1045,71 @@ class PaymentSecurityService:
             Tuple[bool, Optional[str]]: (Разрешен ли платеж, Причина отказа)
         """
         try:
-            repos = RepositoryManager(session)
+            hour_count, daily_total = await self._get_limit_counters(session, user_id)
             
             # Проверяем количество попыток за час
-            hour_ago = datetime.utcnow() - timedelta(hours=1)
-            recent_payments = await repos.payments.get_user_payments_since(user_id, hour_ago)
-            
-            if len(recent_payments) >= self.max_attempts_per_hour:
+            if hour_count >= self.max_attempts_per_hour:
                 return False, "Превышен лимит попыток оплаты в час"
             
             # Проверяем сумму за день
-            day_ago = datetime.utcnow() - timedelta(days=1)
-            daily_payments = await repos.payments.get_user_payments_since(user_id, day_ago)
-            daily_total = sum(p.amount for p in daily_payments if p.status == PaymentStatus.COMPLETED)
-            
             if daily_total + amount > self.max_amount_per_day:
                 return False, "Превышен дневной лимит платежей"
             
             return True, None
             
-        except Exception as e:
+        except _DATA_ERRORS as e:
             logger.error(f"Error checking payment limits: {e}")
             return False, "Ошибка проверки лимитов"
     
+    async def _get_limit_counters(
+        self,
+        session: AsyncSession,
+        user_id: int
+    ) -> Tuple[int, Decimal]:
+        """Получить счетчики лимитов с коротким кешированием"""
+        cached = self._limits_cache.get(user_id)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1], cached[2]
+        
+        # Параллельные проверки одного пользователя ждут один запрос
+        lock = self._limits_locks[user_id]
+        try:
+            async with lock:
+                cached = self._limits_cache.get(user_id)
+                if cached and time.monotonic() < cached[0]:
+                    return cached[1], cached[2]
+                
+                repos = RepositoryManager(session)
+                
+                # Счетчики за час и за сутки одним агрегирующим запросом
+                now = _now()
+                hour_ago = now - _ONE_HOUR
+                day_ago = now - _ONE_DAY
+                hour_count, daily_total = await repos.payments.get_limit_counters(
+                    user_id, hour_ago, day_ago
+                )
+                
+                # Кеш ограничен по размеру: вытесняем самую старую запись
+                self._limits_cache.pop(user_id, None)
+                if len(self._limits_cache) >= self.limits_cache_max_size:
+                    del self._limits_cache[next(iter(self._limits_cache))]
+                self._limits_cache[user_id] = (
+                    time.monotonic() + self.limits_cache_ttl, hour_count, daily_total
+                )
+                return hour_count, daily_total
+        finally:
+            # Блокировка нужна только на время запроса
+            if not lock.locked() and self._limits_locks.get(user_id) is lock:
+                del self._limits_locks[user_id]
+    
+    def invalidate_limits(self, user_id: int):
+        """Сбросить кеш счетчиков лимитов пользователя"""
+        self._limits_cache.pop(user_id, None)
+        
+        lock = self._limits_locks.get(user_id)
+        if lock and not lock.locked():
+            del self._limits_locks[user_id]
+    
     async def detect_suspicious_activity(
         self,
         session: AsyncSession,
@@ -1020,35 +1128,37 @@ class PaymentSecurityService:
             bool: Обнаружена ли подозрительная активность
         """
         try:
-            repos = RepositoryManager(session)
+            # Проверяем необычно большие суммы (без запроса к БД)
+            amount = _to_decimal(payment_data.get("amount", 0))
+            if amount > _SUSPICIOUS_AMOUNT:
+                logger.warning(f"Suspicious activity: large amount {amount} from user {user_id}")
+                return True
             
-            # Проверяем частые платежи
-            hour_ago = datetime.utcnow() - timedelta(hours=1)
-            recent_payments = await repos.payments.get_user_payments_since(user_id, hour_ago)
+            # Проверяем частые платежи: счетчик за час общий с check_payment_limits
+            hour_count, _ = await self._get_limit_counters(session, user_id)
             
-            if len(recent_payments) > 3:
+            if hour_count > 3:
                 logger.warning(f"Suspicious activity: too many payments from user {user_id}")
                 return True
             
-            # Проверяем необычно большие суммы
-            amount = Decimal(str(payment_data.get("amount", 0)))
-            if amount > Decimal("5000.00"):
-                logger.warning(f"Suspicious activity: large amount {amount} from user {user_id}")
-                return True
-            
             return False
             
-        except Exception as e:
+        except _DATA_ERRORS as e:
             logger.error(f"Error detecting suspicious activity: {e}")
             return False
 
 
+# Глобальный экземпляр: кеш лимитов общий для всех сессий
+payment_security_service = PaymentSecurityService()
+
+
 class PaymentNotificationService:
     """Сервис уведомлений о платежах"""
     
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, repos: Optional[RepositoryManager] = None):
         self.session = session
-        self.user_service = UserService(session)
+        self.repos = repos or RepositoryManager(session)
+        self.user_service = UserService(session, self.repos)
     
     async def notify_payment_success(
         self,
@@ -1061,8 +1171,7 @@ class PaymentNotificationService:
             payment_id: ID платежа
         """
         try:
-            repos = RepositoryManager(self.session)
-            payment = await repos.payments.get_by_id(payment_id)
+            payment = await self.repos.payments.get_notify_fields(payment_id)
             
             if payment:
                 await self.user_service.log_user_action(
@@ -1077,7 +1186,7 @@ class PaymentNotificationService:
                 
                 logger.info(f"Payment success notification sent for payment {payment_id}")
                 
-        except Exception as e:
+        except _DATA_ERRORS as e:
             logger.error(f"Error sending payment success notification: {e}")
     
     async def notify_payment_failure(
@@ -1093,8 +1202,7 @@ class PaymentNotificationService:
             reason: Причина неудачи
         """
         try:
-            repos = RepositoryManager(self.session)
-            payment = await repos.payments.get_by_id(payment_id)
+            payment = await self.repos.payments.get_notify_fields(payment_id)
             
             if payment:
                 await self.user_service.log_user_action(
@@ -1109,18 +1217,91 @@ class PaymentNotificationService:
                 
                 logger.info(f"Payment failure notification sent for payment {payment_id}")
                 
-        except Exception as e:
+        except _DATA_ERRORS as e:
             logger.error(f"Error sending payment failure notification: {e}")
 
 
+# Маски GROUPING(day, currency, payment_method) из revenue_rollup
+_ROLLUP_BY_DAY = 0b011
+_ROLLUP_BY_CURRENCY = 0b101
+_ROLLUP_BY_METHOD = 0b110
+_ROLLUP_TOTAL = 0b111
+
+
 class PaymentAnalyticsService:
     """Сервис аналитики платежей"""
     
+    # Кеш дашбордов, общий для всех экземпляров: key -> (истекает, значение)
+    DASHBOARD_CACHE_TTL = 60
+    _dashboard_cache: Dict[Any, Tuple[float, Dict[str, Any]]] = {}
+    _dashboard_refreshes: Dict[Any, asyncio.Task] = {}
+    
     def __init__(self, session: AsyncSession):
         self.session = session
         self.repos = RepositoryManager(session)
     
+    async def _get_cached_dashboard(self, method_name: str, *args) -> Dict[str, Any]:
+        """
+        Получить дашборд из кеша (stale-while-revalidate)
+        
+        Свежее значение возвращается сразу, устаревшее - тоже, но с фоновым
+        обновлением; при промахе дашборд считается синхронно.
+        """
+        key = (method_name, *args)
+        cached = self._dashboard_cache.get(key)
+        
+        if cached:
+            expires_at, value = cached
+            if time.monotonic() >= expires_at and key not in self._dashboard_refreshes:
+                # Сессия запроса может закрыться раньше, обновляем в своей
+                self._dashboard_refreshes[key] = asyncio.create_task(
+                    self._refresh_dashboard(key, method_name, *args)
+                )
+            return value
+        
+        value = await getattr(self, method_name)(*args)
+        self._store_dashboard(key, value)
+        return value
+    
+    @classmethod
+    def _store_dashboard(cls, key: Any, value: Dict[str, Any]):
+        """Сохранить дашборд в кеш (пустой результат ошибки не кешируется)"""
+        if value:
+            cls._dashboard_cache[key] = (time.monotonic() + cls.DASHBOARD_CACHE_TTL, value)
+    
+    @classmethod
+    async def _refresh_dashboard(cls, key: Any, method_name: str, *args):
+        """Фоново пересчитать дашборд в отдельной сессии"""
+        try:
+            value = await run_in_own_session(lambda s: getattr(cls(s), method_name)(*args))
+            cls._store_dashboard(key, value)
+        except Exception as e:
+            logger.error(f"Error refreshing dashboard {method_name}: {e}")
+        finally:
+            cls._dashboard_refreshes.pop(key, None)
+    
     async def get_revenue_statistics(self, days: int = 30) -> Dict[str, Any]:
+        """
+        Получить статистику доходов (с кешированием)
+        
+        Args:
+            days: Количество дней для анализа
+            
+        Returns:
+            Dict[str, Any]: Статистика доходов
+        """
+        return await self._get_cached_dashboard("_compute_revenue_statistics", days)
+    
+    async def get_payment_method_stats(self) -> Dict[str, Any]:
+        """
+        Получить статистику по методам оплаты (с кешированием)
+        
+        Returns:
+            Dict[str, Any]: Статистика методов оплаты
+        """
+        return await self._get_cached_dashboard("_compute_payment_method_stats")
+    
+    async def _compute_revenue_statistics(self, days: int = 30) -> Dict[str, Any]:
         """
         Получить статистику доходов
         
@@ -1131,8 +1312,10 @@ class PaymentAnalyticsService:
             Dict[str, Any]: Статистика доходов
         """
         try:
-            # В реальной реализации здесь были бы сложные запросы к БД
-            return {
+            since = _now() - timedelta(days=days)
+            rows = await self.repos.payments.revenue_rollup(since)
+            
+            stats = {
                 "period_days": days,
                 "total_revenue": 0.0,
                 "revenue_by_currency": {
@@ -1150,11 +1333,28 @@ class PaymentAnalyticsService:
                 "daily_breakdown": {}
             }
             
-        except Exception as e:
+            # Раскладываем строки по наборам группировки
+            for day, currency, method, grouping, revenue, completed, total in rows:
+                revenue = float(revenue)
+                if grouping == _ROLLUP_TOTAL:
+                    stats["total_revenue"] = revenue
+                    stats["payment_count"] = completed
+                    stats["average_payment"] = revenue / completed if completed else 0.0
+                    stats["conversion_rate"] = completed / total if total else 0.0
+                elif grouping == _ROLLUP_BY_DAY:
+                    stats["daily_breakdown"][day.date().isoformat()] = revenue
+                elif grouping == _ROLLUP_BY_CURRENCY:
+                    stats["revenue_by_currency"][currency] = revenue
+                elif grouping == _ROLLUP_BY_METHOD:
+                    stats["revenue_by_method"][method] = revenue
+            
+            return stats
+            
+        except _DATA_ERRORS as e:
             logger.error(f"Error getting revenue statistics: {e}")
             return {}
     
-    async def get_payment_method_stats(self) -> Dict[str, Any]:
+    async def _compute_payment_method_stats(self) -> Dict[str, Any]:
         """
         Получить статистику по методам оплаты
         
@@ -1179,7 +1379,7 @@ class PaymentAnalyticsService:
                 }
             }
             
-        except Exception as e:
+        except _DATA_ERRORS as e:
             logger.error(f"Error getting payment method statistics: {e}")
             return {}
     
@@ -1194,54 +1394,43 @@ class PaymentAnalyticsService:
             Dict[str, Any]: Поведенческая статистика
         """
         try:
-            payments = await self.repos.payments.get_user_payments(user_id)
+            groups = await self.repos.payments.aggregate_user_behavior(user_id)
             
-            if not payments:
+            if not groups:
                 return {}
             
-            successful_payments = [p for p in payments if p.status == PaymentStatus.COMPLETED]
+            successful = [g for g in groups if g[1] is _STATUS_COMPLETED]
+            total_payments = sum(g[2] for g in groups)
+            successful_count = sum(g[2] for g in successful)
+            total_spent = sum((g[3] or 0 for g in successful), _ZERO)
             
             return {
-                "total_payments": len(payments),
-                "successful_payments": len(successful_payments),
-                "success_rate": len(successful_payments) / len(payments) if payments else 0,
-                "total_spent": sum(p.amount for p in successful_payments),
-                "average_payment": sum(p.amount for p in successful_payments) / len(successful_payments) if successful_payments else 0,
-                "preferred_method": self._get_preferred_payment_method(payments),
-                "first_payment": payments[0].created_at.isoformat() if payments else None,
-                "last_payment": payments[-1].created_at.isoformat() if payments else None,
-                "payment_frequency": self._calculate_payment_frequency(successful_payments)
+                "total_payments": total_payments,
+                "successful_payments": successful_count,
+                "success_rate": successful_count / total_payments if total_payments else 0,
+                "total_spent": total_spent,
+                "average_payment": total_spent / successful_count if successful_count else 0,
+                "preferred_method": self._get_preferred_payment_method(groups),
+                "first_payment": min(g[4] for g in groups).isoformat(),
+                "last_payment": max(g[5] for g in groups).isoformat(),
+                "payment_frequency": await self._calculate_payment_frequency(user_id)
             }
             
-        except Exception as e:
+        except _DATA_ERRORS as e:
             logger.error(f"Error getting user payment behavior: {e}")
             return {}
     
-    def _get_preferred_payment_method(self, payments: List[Payment]) -> Optional[str]:
-        """Определить предпочитаемый метод оплаты"""
-        if not payments:
-            return None
+    def _get_preferred_payment_method(self, groups: List[Any]) -> Optional[str]:
+        """Определить предпочитаемый метод оплаты по агрегатам"""
+        method_counts = Counter()
+        for method, _, count, *_ in groups:
+            method_counts[method] += count
         
-        method_counts = {}
-        for payment in payments:
-            method = payment.payment_method.value
-            method_counts[method] = method_counts.get(method, 0) + 1
-        
-        return max(method_counts, key=method_counts.get)
+        return method_counts.most_common(1)[0][0] if method_counts else None
     
-    def _calculate_payment_frequency(self, payments: List[Payment]) -> float:
+    async def _calculate_payment_frequency(self, user_id: int) -> float:
         """Рассчитать частоту платежей (дней между платежами)"""
-        if len(payments) < 2:
-            return 0.0
-        
-        payments = sorted(payments, key=lambda p: p.created_at)
-        intervals = []
-        
-        for i in range(1, len(payments)):
-            interval = (payments[i].created_at - payments[i-1].created_at).days
-            intervals.append(interval)
-        
-        return sum(intervals) / len(intervals) if intervals else 0.0
+        return await self.repos.payments.get_user_avg_interval_days(user_id)
 
 
 # Константы для платежной системы
@@ -1259,7 +1448,7 @@ class PaymentConstants:
     CRYPTOPAY_TIMEOUT_HOURS = 1
     
     # Валюты
-    SUPPORTED_CURRENCIES = ["RUB", "USD", "EUR", "BTC", "ETH", "USDT"]
+    SUPPORTED_CURRENCIES = ("RUB", "USD", "EUR", "BTC", "ETH", "USDT")
     DEFAULT_CURRENCY = "RUB"
     
     # Конвертация (примерная)
@@ -1270,6 +1459,16 @@ class PaymentConstants:
     }
 
 
+# Множество валют для быстрой проверки
+_VALID_CURRENCIES: frozenset = frozenset(PaymentConstants.SUPPORTED_CURRENCIES)
+
+# Курсы конвертации по паре валют, заранее приведенные к Decimal
+_DECIMAL_RATES: Dict[Tuple[str, str], Decimal] = {
+    tuple(key.split("_TO_")): Decimal(str(rate))
+    for key, rate in PaymentConstants.CURRENCY_RATES.items()
+}
+
+
 def get_payment_service(session: AsyncSession) -> PaymentService:
     """
     Получить экземпляр PaymentService
@@ -1296,7 +1495,7 @@ def get_webhook_service(session: AsyncSession) -> PaymentWebhookService:
     return PaymentWebhookService(session)
 
 
-async def convert_currency(
+def convert_currency(
     amount: Decimal,
     from_currency: str,
     to_currency: str
@@ -1316,10 +1515,8 @@ async def convert_currency(
         return amount
     
     # Простая конвертация (в реальности использовался бы внешний API)
-    rate_key = f"{from_currency}_TO_{to_currency}"
-    rate = PaymentConstants.CURRENCY_RATES.get(rate_key, 1.0)
-    
-    return amount * Decimal(str(rate))
+    rate = _DECIMAL_RATES.get((from_currency, to_currency))
+    return amount if rate is None else amount * rate
 
 
 class PaymentError(Exception):
@@ -3,7 +3,10 @@
 """
 
 import asyncio
-from typing import Optional, List, Dict, Any
+import random
+import time
+from collections import defaultdict
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable
 from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
@@ -12,7 +15,111 @@ from core.database.models import Server, VpnProtocol, User
 from core.database.repositories import RepositoryManager
 from core.services.vpn.vpn_factory import VpnServiceManager, VpnServiceFactory
 from core.exceptions.vpn_exceptions import VpnServerNotAvailableError
+from core.services.activity_service import activity_log_buffer, server_stats_history_buffer
 from config.settings import settings
+from config.database import run_in_own_session
+
+
+# Протоколы по строковому значению: поиск без исключений на неизвестных
+_PROTOCOLS_BY_VALUE: Dict[str, VpnProtocol] = {p.value: p for p in VpnProtocol}
+
+# Кеш списков серверов: key -> (истекает, ID серверов). ORM-объекты не кешируем -
+# они привязаны к загрузившей их сессии; серверы перечитываются по ID в сессии вызывающего
+SERVER_LIST_CACHE_TTL = 15
+_server_list_cache: Dict[Any, Tuple[float, List[int]]] = {}
+
+
+async def _cached_servers(
+    repos: RepositoryManager,
+    key: Any,
+    loader: Callable[[], Awaitable[List[Server]]]
+) -> List[Server]:
+    """Получить список серверов по закешированным ID или загрузить его"""
+    cached = _server_list_cache.get(key)
+    if cached and time.monotonic() < cached[0]:
+        return await repos.servers.get_by_ids(cached[1])
+    
+    servers = await loader()
+    if servers:
+        _server_list_cache[key] = (
+            time.monotonic() + SERVER_LIST_CACHE_TTL, [server.id for server in servers]
+        )
+    return servers
+
+
+def invalidate_server_list_cache():
+    """Сбросить кеш списков серверов"""
+    _server_list_cache.clear()
+
+
+# Сколько наименее нагруженных серверов участвует во взвешенном выборе
+BALANCER_TOP_K = 16
+
+# Таймаут одной проверки сервера через VPN протокол
+VPN_PROBE_TIMEOUT = 5
+
+# Кеш результатов проверки здоровья: server_id -> (истекает, результат)
+HEALTH_CACHE_TTL = 30
+_health_cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+_health_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def _get_cached_health(server_id: int) -> Optional[Dict[str, Any]]:
+    """Получить результат проверки здоровья из кеша"""
+    cached = _health_cache.get(server_id)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+    return None
+
+
+def invalidate_server_health(server_id: int):
+    """Сбросить кешированный результат проверки здоровья сервера"""
+    _health_cache.pop(server_id, None)
+
+
+async def _bounded(semaphore: asyncio.Semaphore, coro, timeout: float):
+    """Выполнить корутину под семафором и с таймаутом"""
+    async with semaphore:
+        return await asyncio.wait_for(coro, timeout=timeout)
+
+
+class ServerLoadView:
+    """
+    Снимок нагрузки серверов в виде параллельных списков
+    
+    Атрибуты ORM-объектов читаются один раз при построении, дальше расчеты
+    идут по спискам, а Server берется только для выбранного индекса.
+    """
+    
+    __slots__ = ("servers", "loads", "max_users", "maintenance")
+    
+    def __init__(self, servers: List[Server]):
+        self.servers = servers
+        self.loads: List[float] = []
+        self.max_users: List[int] = []
+        self.maintenance: List[bool] = []
+        
+        for server in servers:
+            self.loads.append(ServerService._calculate_server_load(server))
+            self.max_users.append(server.max_users)
+            self.maintenance.append(server.is_maintenance)
+    
+    def balance_weights(self) -> List[float]:
+        """Веса серверов для балансировки (меньше нагрузка = больше вес)"""
+        weights = []
+        for load, max_users, maintenance in zip(self.loads, self.max_users, self.maintenance):
+            weight = 1.0 - load
+            
+            # Бонус за высокую производительность
+            if max_users > 500:
+                weight *= 1.2
+            
+            # Штраф за техническое обслуживание
+            if maintenance:
+                weight *= 0.1
+            
+            weights.append(max(weight, 0.01))
+        return weights
 
 
 class ServerService:
@@ -35,9 +142,45 @@ class ServerService:
         """
         if include_inactive:
             # Здесь нужен метод для получения всех серверов
-            return await self.repos.servers.get_all_active()  # Пока используем активные
+            return await self.get_active_servers()  # Пока используем активные
         else:
-            return await self.repos.servers.get_all_active()
+            return await self.get_active_servers()
+    
+    async def get_active_servers(self) -> List[Server]:
+        """Получить активные серверы (с коротким кешированием)"""
+        return await _cached_servers(self.repos, ("active",), self.repos.servers.get_all_active)
+    
+    async def get_candidate_servers(
+        self,
+        protocol: Optional[VpnProtocol] = None,
+        country_codes: Optional[List[str]] = None,
+        exclude_ids: Optional[List[int]] = None,
+        max_load: Optional[float] = None,
+        order_by_load: bool = False,
+        limit: Optional[int] = None
+    ) -> List[Server]:
+        """Получить серверы-кандидаты (с коротким кешированием)"""
+        key = (
+            "candidates",
+            protocol,
+            tuple(country_codes or ()),
+            tuple(sorted(exclude_ids or ())),
+            max_load,
+            order_by_load,
+            limit
+        )
+        return await _cached_servers(
+            self.repos,
+            key,
+            lambda: self.repos.servers.get_candidates(
+                protocol=protocol,
+                country_codes=country_codes,
+                exclude_ids=exclude_ids,
+                max_load=max_load,
+                order_by_load=order_by_load,
+                limit=limit
+            )
+        )
     
     async def get_server_by_id(self, server_id: int) -> Optional[Server]:
         """
@@ -67,39 +210,35 @@ class ServerService:
             Optional[Server]: Лучший сервер
         """
         try:
-            # Получаем серверы по протоколу
-            if protocol:
-                servers = await self.repos.servers.get_by_protocol(protocol)
-            else:
-                servers = await self.repos.servers.get_all_active()
+            # Фильтрация и выбор наименее нагруженного сервера выполняются в БД
+            servers = []
             
-            if not servers:
-                return None
-            
-            # Фильтруем серверы по географии для российских пользователей
+            # Для российских пользователей сначала ищем в предпочтительных странах
             if user.country_code in settings.RUSSIA_COUNTRY_CODES:
-                preferred_countries = ["NL", "DE", "FI", "LV", "EE", "SE"]
-                preferred_servers = [s for s in servers if s.country_code in preferred_countries]
-                if preferred_servers:
-                    servers = preferred_servers
-            
-            # Выбираем сервер с наименьшей нагрузкой
-            best_server = None
-            best_load = float('inf')
+                servers = await self.get_candidate_servers(
+                    protocol=protocol,
+                    country_codes=["NL", "DE", "FI", "LV", "EE", "SE"],
+                    max_load=0.9,
+                    order_by_load=True,
+                    limit=1
+                )
             
-            for server in servers:
-                load = await self._calculate_server_load(server)
-                if load < best_load and load < 0.9:  # Не перегруженный сервер
-                    best_load = load
-                    best_server = server
+            if not servers:
+                servers = await self.get_candidate_servers(
+                    protocol=protocol,
+                    max_load=0.9,
+                    order_by_load=True,
+                    limit=1
+                )
             
-            return best_server
+            return servers[0] if servers else None
             
         except Exception as e:
             logger.error(f"Error selecting best server for user {user.id}: {e}")
             return None
     
-    async def _calculate_server_load(self, server: Server) -> float:
+    @staticmethod
+    def _calculate_server_load(server: Server) -> float:
         """
         Рассчитать нагрузку сервера
         
@@ -110,19 +249,7 @@ class ServerService:
             float: Нагрузка (0.0 - 1.0)
         """
         try:
-            # Нагрузка по пользователям
-            user_load = server.current_users / server.max_users if server.max_users > 0 else 0
-            
-            # Нагрузка по CPU
-            cpu_load = float(server.cpu_usage) / 100.0
-            
-            # Нагрузка по памяти
-            memory_load = float(server.memory_usage) / 100.0
-            
-            # Общая нагрузка (взвешенная)
-            total_load = (user_load * 0.5) + (cpu_load * 0.3) + (memory_load * 0.2)
-            
-            return min(total_load, 1.0)
+            return server.load
             
         except Exception as e:
             logger.error(f"Error calculating server load: {e}")
@@ -143,62 +270,82 @@ class ServerService:
             if not server:
                 return False
             
-            # Получаем статистику через VPN сервисы
-            stats = {}
-            
-            # Пробуем получить статистику через каждый поддерживаемый протокол
-            for protocol_str in server.supported_protocols:
-                try:
-                    protocol = VpnProtocol(protocol_str)
-                    if VpnServiceFactory.is_protocol_supported(protocol):
-                        service = self.vpn_manager.get_service(protocol, server)
-                        
-                        # Получаем информацию о сервере
-                        if hasattr(service, 'get_server_info'):
-                            server_info = await service.get_server_info()
-                            if server_info:
-                                stats.update(server_info)
-                                break
-                        
-                except Exception as e:
-                    logger.warning(f"Failed to get stats via {protocol_str}: {e}")
-                    continue
-            
-            # Обновляем статистику в базе данных
-            update_data = {
-                "last_check": datetime.utcnow()
-            }
-            
-            if stats:
-                if "cpu" in stats:
-                    update_data["cpu_usage"] = stats["cpu"]
-                if "memory" in stats:
-                    update_data["memory_usage"] = stats["memory"]
-                if "disk" in stats:
-                    update_data["disk_usage"] = stats["disk"]
-                if "total_clients" in stats:
-                    update_data["current_users"] = stats["total_clients"]
-            
-            success = await self.repos.servers.update_stats(server_id, **update_data)
-            
-            # Записываем статистику в историю
-            if stats:
-                await self.repos.server_stats.record_stats(
-                    server_id=server_id,
-                    active_connections=update_data.get("current_users", 0),
-                    cpu_usage=update_data.get("cpu_usage", 0),
-                    memory_usage=update_data.get("memory_usage", 0),
-                    disk_usage=update_data.get("disk_usage", 0)
-                )
-            
-            await self.repos.commit()
-            return success
+            update_row, history_row = await self.collect_server_stats_update(server)
+            return await self._write_server_stats([update_row], [history_row] if history_row else [])
             
         except Exception as e:
             await self.repos.rollback()
+            invalidate_server_health(server_id)
             logger.error(f"Error updating server stats {server_id}: {e}")
             return False
     
+    async def collect_server_stats_update(
+        self,
+        server: Server
+    ) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """
+        Опросить сервер и подготовить строки для записи статистики
+        
+        Args:
+            server: Сервер
+            
+        Returns:
+            Tuple: Строка обновления servers и строка истории (или None)
+        """
+        # Получаем статистику через VPN сервисы
+        stats = {}
+        
+        # Неактивные и обслуживаемые серверы по сети не опрашиваем
+        if server.is_active and not server.is_maintenance:
+            stats = await self._collect_server_stats(server)
+        
+        update_row = {
+            "id": server.id,
+            "last_check": datetime.utcnow()
+        }
+        
+        if "cpu" in stats:
+            update_row["cpu_usage"] = stats["cpu"]
+        if "memory" in stats:
+            update_row["memory_usage"] = stats["memory"]
+        if "disk" in stats:
+            update_row["disk_usage"] = stats["disk"]
+        if "total_clients" in stats:
+            update_row["current_users"] = stats["total_clients"]
+        
+        if not stats:
+            return update_row, None
+        
+        history_row = {
+            "server_id": server.id,
+            "active_connections": update_row.get("current_users", 0),
+            "cpu_usage": update_row.get("cpu_usage", 0),
+            "memory_usage": update_row.get("memory_usage", 0),
+            "disk_usage": update_row.get("disk_usage", 0)
+        }
+        return update_row, history_row
+    
+    async def _write_server_stats(
+        self,
+        update_rows: List[Dict[str, Any]],
+        history_rows: List[Dict[str, Any]]
+    ) -> bool:
+        """
+        Записать статистику серверов одним UPDATE и одним коммитом
+        
+        История в server_stats уходит в фоновый буфер и пишется пачками
+        после коммита, вне критического пути.
+        """
+        await self.repos.servers.bulk_update_stats(update_rows)
+        await self.repos.commit()
+        
+        for row in history_rows:
+            server_stats_history_buffer.enqueue(row)
+        
+        # Нагрузка изменилась - списки кандидатов устарели
+        invalidate_server_list_cache()
+        return True
+    
     async def update_all_server_stats(self) -> int:
         """
         Обновить статистику всех активных серверов
@@ -206,54 +353,217 @@ class ServerService:
         Returns:
             int: Количество обновленных серверов
         """
+        servers = []
         try:
-            servers = await self.repos.servers.get_all_active()
-            updated_count = 0
+            servers = await self.get_active_servers()
             
-            # Создаем задачи для параллельного обновления
-            tasks = []
-            for server in servers:
-                task = asyncio.create_task(self.update_server_stats(server.id))
-                tasks.append(task)
+            # Параллельный опрос с ограничением числа одновременных задач;
+            # зависший сервер прерывается по таймауту. В БД опрос не пишет
+            semaphore = asyncio.Semaphore(settings.SERVER_STATS_CONCURRENCY)
+            tasks = [
+                _bounded(semaphore, self.collect_server_stats_update(server), settings.SERVER_STATS_TIMEOUT)
+                for server in servers
+            ]
             
-            # Выполняем задачи с ограничением времени
             results = await asyncio.gather(*tasks, return_exceptions=True)
             
-            # Подсчитываем успешные обновления
-            for result in results:
-                if isinstance(result, bool) and result:
-                    updated_count += 1
-                elif isinstance(result, Exception):
-                    logger.error(f"Server stats update failed: {result}")
+            update_rows = []
+            history_rows = []
+            for server, result in zip(servers, results):
+                if isinstance(result, BaseException):
+                    invalidate_server_health(server.id)
+                    logger.error(f"Server stats update failed for {server.id}: {result!r}")
+                    continue
+                
+                update_row, history_row = result
+                update_rows.append(update_row)
+                if history_row:
+                    history_rows.append(history_row)
+            
+            # Все результаты пишем одним запросом и одним коммитом
+            if update_rows:
+                await self._write_server_stats(update_rows, history_rows)
             
+            updated_count = len(update_rows)
             logger.info(f"Updated stats for {updated_count}/{len(servers)} servers")
             return updated_count
             
         except Exception as e:
+            await self.repos.rollback()
+            for server in servers:
+                invalidate_server_health(server.id)
             logger.error(f"Error updating all server stats: {e}")
             return 0
     
-    async def check_server_health(self, server_id: int) -> Dict[str, Any]:
+    async def _collect_server_stats(self, server: Server) -> Dict[str, Any]:
+        """Получить статистику сервера через первый ответивший протокол"""
+        # Опрашиваем все поддерживаемые протоколы параллельно
+        protocols = []
+        for protocol_str in server.supported_protocols:
+            protocol = _PROTOCOLS_BY_VALUE.get(protocol_str)
+            if protocol is None:
+                logger.warning(f"Unknown protocol in server config: {protocol_str}")
+                continue
+            if VpnServiceFactory.is_protocol_supported(protocol):
+                protocols.append(protocol)
+        
+        results = await asyncio.gather(
+            *(self._probe_server_info(protocol, server) for protocol in protocols),
+            return_exceptions=True
+        )
+        
+        # Берем первый успешный ответ в порядке протоколов
+        for protocol, server_info in zip(protocols, results):
+            if isinstance(server_info, BaseException):
+                logger.warning(f"Failed to get stats via {protocol.value}: {server_info}")
+                continue
+            if server_info:
+                return server_info
+        
+        return {}
+    
+    async def _check_vpn_protocols(self, server: Server) -> Dict[str, Dict[str, Any]]:
+        """Проверить доступность сервера по всем протоколам параллельно"""
+        vpn_checks = {}
+        protocols = []
+        for protocol_str in server.supported_protocols:
+            protocol = _PROTOCOLS_BY_VALUE.get(protocol_str)
+            if protocol is None:
+                vpn_checks[protocol_str] = {
+                    "status": "fail",
+                    "message": f"Unknown protocol: {protocol_str}"
+                }
+                continue
+            if VpnServiceFactory.is_protocol_supported(protocol):
+                protocols.append(protocol)
+        
+        results = await asyncio.gather(
+            *(self._probe_protocol(protocol, server) for protocol in protocols),
+            return_exceptions=True
+        )
+        
+        for protocol, result in zip(protocols, results):
+            protocol_str = protocol.value
+            if isinstance(result, BaseException):
+                vpn_checks[protocol_str] = {
+                    "status": "fail",
+                    "message": f"Error checking {protocol_str}: {str(result) or type(result).__name__}"
+                }
+                continue
+            
+            check_name, check_ok = result
+            vpn_checks[protocol_str] = {
+                "status": "pass" if check_ok else "fail",
+                "message": f"{protocol_str.upper()} {check_name}"
+            }
+        
+        return vpn_checks
+    
+    async def _probe_server_info(self, protocol: VpnProtocol, server: Server) -> Optional[Dict[str, Any]]:
+        """Получить информацию о сервере через VPN протокол с таймаутом"""
+        service = self.vpn_manager.get_service(protocol, server)
+        if not hasattr(service, 'get_server_info'):
+            return None
+        return await asyncio.wait_for(service.get_server_info(), timeout=VPN_PROBE_TIMEOUT)
+    
+    @staticmethod
+    async def _probe_protocol(protocol: VpnProtocol, server: Server) -> Tuple[str, bool]:
+        """
+        Проверить сервер через VPN протокол
+        
+        test_connection обращается к БД, а одну AsyncSession нельзя
+        использовать конкурентно, поэтому каждая проверка идет в своей сессии.
+        """
+        async def probe(session: AsyncSession) -> Tuple[str, bool]:
+            service = VpnServiceManager(session).get_service(protocol, server)
+            
+            # Тестируем соединение
+            if hasattr(service, 'test_connection'):
+                connection_ok = await asyncio.wait_for(
+                    service.test_connection(0),  # Dummy config ID
+                    timeout=VPN_PROBE_TIMEOUT
+                )
+                return "connection test", connection_ok
+            
+            # Проверяем валидность конфигурации
+            config_valid = await asyncio.wait_for(
+                service.validate_server_config(),
+                timeout=VPN_PROBE_TIMEOUT
+            )
+            return "configuration validation", config_valid
+        
+        return await run_in_own_session(probe)
+    
+    async def check_server_health(
+        self,
+        server_id: int,
+        now_iso: Optional[str] = None,
+        *,
+        server: Optional[Server] = None
+    ) -> Dict[str, Any]:
         """
-        Проверить здоровье сервера
+        Проверить здоровье сервера по ID
         
         Args:
             server_id: ID сервера
+            now_iso: Время проверки в ISO формате (общее для всего обхода)
+            server: Уже загруженный сервер (без повторного запроса к БД)
             
         Returns:
             Dict[str, Any]: Результаты проверки здоровья
         """
-        try:
+        cached = _get_cached_health(server_id)
+        if cached is not None:
+            return cached
+        
+        if server is None:
             server = await self.repos.servers.get_by_id(server_id)
-            if not server:
-                return {"healthy": False, "error": "Server not found"}
+        if not server:
+            return {"healthy": False, "error": "Server not found"}
+        
+        return await self.check_loaded_server_health(server, now_iso)
+    
+    async def check_loaded_server_health(self, server: Server, now_iso: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Проверить здоровье уже загруженного сервера (без повторного запроса к БД)
+        
+        Результат кешируется на HEALTH_CACHE_TTL секунд, одновременные
+        проверки одного сервера ждут первую вместо повторных запросов.
+        
+        Args:
+            server: Сервер
+            now_iso: Время проверки в ISO формате (общее для всего обхода)
             
+        Returns:
+            Dict[str, Any]: Результаты проверки здоровья
+        """
+        server_id = server.id
+        cached = _get_cached_health(server_id)
+        if cached is not None:
+            return cached
+        
+        async with _health_locks[server_id]:
+            cached = _get_cached_health(server_id)
+            if cached is not None:
+                return cached
+            
+            health_status = await self._probe_server_health(
+                server, now_iso or datetime.utcnow().isoformat()
+            )
+            if "error" not in health_status:
+                _health_cache[server_id] = (time.monotonic() + HEALTH_CACHE_TTL, health_status)
+            return health_status
+    
+    async def _probe_server_health(self, server: Server, now_iso: str) -> Dict[str, Any]:
+        """Выполнить проверки здоровья сервера"""
+        server_id = server.id
+        try:
             health_status = {
                 "server_id": server_id,
                 "healthy": True,
                 "checks": {},
                 "overall_status": "healthy",
-                "last_check": datetime.utcnow().isoformat()
+                "last_check": now_iso
             }
             
             # Проверка активности сервера
@@ -269,7 +579,7 @@ class ServerService:
             }
             
             # Проверка нагрузки
-            load = await self._calculate_server_load(server)
+            load = self._calculate_server_load(server)
             load_status = "pass" if load < 0.8 else "warn" if load < 0.95 else "fail"
             health_status["checks"]["server_load"] = {
                 "status": load_status,
@@ -277,45 +587,36 @@ class ServerService:
                 "value": load
             }
             
-            # Проверка доступности через VPN сервисы
-            vpn_checks = {}
-            for protocol_str in server.supported_protocols:
-                try:
-                    protocol = VpnProtocol(protocol_str)
-                    if VpnServiceFactory.is_protocol_supported(protocol):
-                        service = self.vpn_manager.get_service(protocol, server)
-                        
-                        # Тестируем соединение
-                        if hasattr(service, 'test_connection'):
-                            connection_ok = await service.test_connection(0)  # Dummy config ID
-                            vpn_checks[protocol_str] = {
-                                "status": "pass" if connection_ok else "fail",
-                                "message": f"{protocol_str.upper()} connection test"
-                            }
-                        else:
-                            # Проверяем валидность конфигурации
-                            config_valid = await service.validate_server_config()
-                            vpn_checks[protocol_str] = {
-                                "status": "pass" if config_valid else "fail",
-                                "message": f"{protocol_str.upper()} configuration validation"
-                            }
-                
-                except Exception as e:
-                    vpn_checks[protocol_str] = {
-                        "status": "fail",
-                        "message": f"Error checking {protocol_str}: {str(e)}"
-                    }
+            # Проверка доступности через VPN сервисы (неактивные и
+            # обслуживаемые серверы по сети не опрашиваем)
+            if server.is_active and not server.is_maintenance:
+                vpn_checks = await self._check_vpn_protocols(server)
+            else:
+                vpn_checks = {}
             
             health_status["checks"]["vpn_protocols"] = vpn_checks
             
-            # Определяем общий статус
-            all_checks = [health_status["checks"]["server_active"]]
+            # Определяем общий статус за один проход (до первого fail)
+            all_checks = [
+                health_status["checks"]["server_active"],
+                health_status["checks"]["maintenance_mode"]
+            ]
             all_checks.extend(vpn_checks.values())
             
-            if any(check["status"] == "fail" for check in all_checks):
+            has_fail = False
+            has_warn = False
+            for check in all_checks:
+                status = check["status"]
+                if status == "fail":
+                    has_fail = True
+                    break
+                if status == "warn":
+                    has_warn = True
+            
+            if has_fail:
                 health_status["overall_status"] = "unhealthy"
                 health_status["healthy"] = False
-            elif any(check["status"] == "warn" for check in all_checks):
+            elif has_warn:
                 health_status["overall_status"] = "degraded"
             
             return health_status
@@ -325,21 +626,28 @@ class ServerService:
             return {
                 "healthy": False,
                 "error": str(e),
-                "last_check": datetime.utcnow().isoformat()
+                "last_check": now_iso
             }
     
-    async def get_server_protocols_status(self, server_id: int) -> Dict[str, Any]:
+    async def get_server_protocols_status(
+        self,
+        server_id: int,
+        *,
+        server: Optional[Server] = None
+    ) -> Dict[str, Any]:
         """
         Получить статус протоколов сервера
         
         Args:
             server_id: ID сервера
+            server: Уже загруженный сервер (без повторного запроса к БД)
             
         Returns:
             Dict[str, Any]: Статус протоколов
         """
         try:
-            server = await self.repos.servers.get_by_id(server_id)
+            if server is None:
+                server = await self.repos.servers.get_by_id(server_id)
             if not server:
                 return {}
             
@@ -404,7 +712,7 @@ class ServerService:
             
             # Логируем создание сервера
             if admin_id:
-                await self.repos.user_activities.log_activity(
+                activity_log_buffer.enqueue(
                     user_id=admin_id,
                     action="server_created",
                     details={
@@ -416,6 +724,7 @@ class ServerService:
                 )
             
             await self.repos.commit()
+            invalidate_server_list_cache()
             logger.info(f"Server created: {server.id} - {name}")
             
             return server
@@ -448,8 +757,11 @@ class ServerService:
                 is_maintenance=maintenance_mode
             )
             
+            if success:
+                await self.repos.commit()
+            
             if success and admin_id:
-                await self.repos.user_activities.log_activity(
+                activity_log_buffer.enqueue(
                     user_id=admin_id,
                     action="server_maintenance_toggled",
                     details={
@@ -458,7 +770,10 @@ class ServerService:
                         "toggled_at": datetime.utcnow().isoformat()
                     }
                 )
-                await self.repos.commit()
+            
+            if success:
+                invalidate_server_list_cache()
+                invalidate_server_health(server_id)
             
             logger.info(f"Server {server_id} maintenance mode: {maintenance_mode}")
             return success
@@ -480,55 +795,41 @@ class ServerService:
             Dict[str, Any]: Статистика сервера
         """
         try:
-            # Получаем статистику из базы данных
-            stats = await self.repos.server_stats.get_server_stats(server_id, days * 24)
+            # Дневные агрегаты считаются в БД
+            rows = await self.repos.server_stats.get_aggregated(server_id, days)
             
-            if not stats:
+            if not rows:
                 return {}
             
-            # Агрегируем данные
-            total_connections = sum(stat.active_connections for stat in stats)
-            avg_cpu = sum(stat.cpu_usage for stat in stats) / len(stats)
-            avg_memory = sum(stat.memory_usage for stat in stats) / len(stats)
-            avg_disk = sum(stat.disk_usage for stat in stats) / len(stats)
-            
-            # Группируем по дням
-            daily_stats = {}
-            for stat in stats:
-                day = stat.recorded_at.date()
-                if day not in daily_stats:
-                    daily_stats[day] = {
-                        "connections": [],
-                        "cpu": [],
-                        "memory": [],
-                        "disk": []
-                    }
-                
-                daily_stats[day]["connections"].append(stat.active_connections)
-                daily_stats[day]["cpu"].append(stat.cpu_usage)
-                daily_stats[day]["memory"].append(stat.memory_usage)
-                daily_stats[day]["disk"].append(stat.disk_usage)
-            
-            # Усредняем по дням
-            for day_data in daily_stats.values():
-                day_data["avg_connections"] = sum(day_data["connections"]) / len(day_data["connections"])
-                day_data["avg_cpu"] = sum(day_data["cpu"]) / len(day_data["cpu"])
-                day_data["avg_memory"] = sum(day_data["memory"]) / len(day_data["memory"])
-                day_data["avg_disk"] = sum(day_data["disk"]) / len(day_data["disk"])
+            total_points = sum(row.data_points for row in rows)
+            
+            def _avg(field: str) -> float:
+                return float(sum(getattr(row, field) or 0 for row in rows)) / total_points
+            
+            daily_stats = {
+                row.day.date(): {
+                    "data_points": row.data_points,
+                    "avg_connections": float(row.connections_sum or 0) / row.data_points,
+                    "avg_cpu": float(row.cpu_sum) / row.data_points,
+                    "avg_memory": float(row.memory_sum) / row.data_points,
+                    "avg_disk": float(row.disk_sum) / row.data_points
+                }
+                for row in rows
+            }
             
             return {
                 "server_id": server_id,
                 "period_days": days,
-                "total_data_points": len(stats),
+                "total_data_points": total_points,
                 "averages": {
-                    "cpu_usage": round(avg_cpu, 2),
-                    "memory_usage": round(avg_memory, 2),
-                    "disk_usage": round(avg_disk, 2),
-                    "connections": round(total_connections / len(stats), 2)
+                    "cpu_usage": round(_avg("cpu_sum"), 2),
+                    "memory_usage": round(_avg("memory_sum"), 2),
+                    "disk_usage": round(_avg("disk_sum"), 2),
+                    "connections": round(_avg("connections_sum"), 2)
                 },
                 "daily_stats": daily_stats,
-                "peak_connections": max(stat.active_connections for stat in stats),
-                "peak_cpu": max(stat.cpu_usage for stat in stats)
+                "peak_connections": max(row.peak_connections or 0 for row in rows),
+                "peak_cpu": float(max(row.peak_cpu for row in rows))
             }
             
         except Exception as e:
@@ -552,10 +853,13 @@ class ServerMonitoringService:
             Dict[str, Any]: Результаты мониторинга
         """
         try:
-            servers = await self.repos.servers.get_all_active()
+            servers = await self.server_service.get_active_servers()
+            
+            # Одна метка времени на весь обход
+            now_iso = datetime.utcnow().isoformat()
             
             monitoring_results = {
-                "timestamp": datetime.utcnow().isoformat(),
+                "timestamp": now_iso,
                 "total_servers": len(servers),
                 "healthy_servers": 0,
                 "degraded_servers": 0,
@@ -563,9 +867,28 @@ class ServerMonitoringService:
                 "servers": []
             }
             
-            # Проверяем каждый сервер
-            for server in servers:
-                health_check = await self.server_service.check_server_health(server.id)
+            # Проверяем серверы параллельно по уже загруженным объектам
+            semaphore = asyncio.Semaphore(settings.SERVER_STATS_CONCURRENCY)
+            health_checks = await asyncio.gather(
+                *[
+                    _bounded(
+                        semaphore,
+                        self.server_service.check_loaded_server_health(server, now_iso),
+                        settings.SERVER_STATS_TIMEOUT
+                    )
+                    for server in servers
+                ],
+                return_exceptions=True
+            )
+            
+            for server, health_check in zip(servers, health_checks):
+                if isinstance(health_check, Exception):
+                    logger.error(f"Health check failed for server {server.id}: {health_check!r}")
+                    health_check = {"healthy": False, "overall_status": "unhealthy"}
+                
+                # Нагрузка уже посчитана при проверке здоровья
+                load_check = health_check.get("checks", {}).get("server_load")
+                load = load_check["value"] if load_check else self.server_service._calculate_server_load(server)
                 
                 server_status = {
                     "id": server.id,
@@ -573,8 +896,8 @@ class ServerMonitoringService:
                     "country": server.country,
                     "status": health_check.get("overall_status", "unknown"),
                     "healthy": health_check.get("healthy", False),
-                    "load": await self.server_service._calculate_server_load(server),
-                    "protocols": list(server.supported_protocols)
+                    "load": load,
+                    "protocols": server.supported_protocols  # общий список, без копии
                 }
                 
                 monitoring_results["servers"].append(server_status)
@@ -673,83 +996,48 @@ class ServerLoadBalancer:
             Optional[Server]: Оптимальный сервер
         """
         try:
-            # Получаем доступные серверы
-            if protocol:
-                servers = await self.repos.servers.get_by_protocol(protocol)
-            else:
-                servers = await self.repos.servers.get_all_active()
+            # Протокол, обслуживание и исключения фильтруются в БД,
+            # во взвешенный выбор попадают только наименее нагруженные серверы
+            servers = []
+            
+            # Для российских пользователей сначала ищем в приоритетных странах
+            if user.country_code in settings.RUSSIA_COUNTRY_CODES:
+                servers = await self.server_service.get_candidate_servers(
+                    protocol=protocol,
+                    country_codes=["NL", "DE", "FI", "LV", "EE", "SE", "NO"],
+                    exclude_ids=exclude_servers,
+                    order_by_load=True,
+                    limit=BALANCER_TOP_K
+                )
             
-            # Исключаем серверы
-            if exclude_servers:
-                servers = [s for s in servers if s.id not in exclude_servers]
+            if not servers:
+                servers = await self.server_service.get_candidate_servers(
+                    protocol=protocol,
+                    exclude_ids=exclude_servers,
+                    order_by_load=True,
+                    limit=BALANCER_TOP_K
+                )
             
             if not servers:
                 return None
             
-            # Фильтруем по географии
-            filtered_servers = await self._filter_by_geography(servers, user)
-            
             # Выбираем сервер с учетом балансировки
-            return await self._select_balanced_server(filtered_servers)
+            return await self._select_balanced_server(servers)
             
         except Exception as e:
             logger.error(f"Error getting optimal server: {e}")
             return None
     
-    async def _filter_by_geography(self, servers: List[Server], user: User) -> List[Server]:
-        """Фильтровать серверы по географии"""
-        if user.country_code not in settings.RUSSIA_COUNTRY_CODES:
-            return servers
-        
-        # Приоритетные страны для российских пользователей
-        priority_countries = ["NL", "DE", "FI", "LV", "EE", "SE", "NO"]
-        
-        # Сначала ищем серверы в приоритетных странах
-        priority_servers = [s for s in servers if s.country_code in priority_countries]
-        if priority_servers:
-            return priority_servers
-        
-        return servers
-    
     async def _select_balanced_server(self, servers: List[Server]) -> Optional[Server]:
         """Выбрать сервер с учетом балансировки нагрузки"""
         if not servers:
             return None
         
-        # Рассчитываем веса серверов
-        server_weights = []
-        for server in servers:
-            load = await self.server_service._calculate_server_load(server)
-            
-            # Инвертируем нагрузку для веса (меньше нагрузка = больше вес)
-            weight = 1.0 - load
-            
-            # Бонус за высокую производительность
-            if server.max_users > 500:
-                weight *= 1.2
-            
-            # Штраф за техническое обслуживание
-            if server.is_maintenance:
-                weight *= 0.1
-            
-            server_weights.append((server, max(weight, 0.01)))
-        
-        # Выбираем сервер методом взвешенного случайного выбора
-        import random
-        
-        total_weight = sum(weight for _, weight in server_weights)
-        if total_weight == 0:
-            return servers[0]  # Возвращаем первый доступный
-        
-        random_value = random.uniform(0, total_weight)
-        current_weight = 0
-        
-        for server, weight in server_weights:
-            current_weight += weight
-            if random_value <= current_weight:
-                return server
+        # Рассчитываем веса серверов по снимку нагрузки
+        weights = ServerLoadView(servers).balance_weights()
         
-        return servers[0]  # Fallback
+        # Взвешенный случайный выбор (бинарный поиск по накопленным весам)
+        return random.choices(servers, weights=weights, k=1)[0]
     
     async def rebalance_users(self, from_server_id: int, to_server_id: int) -> int:
         """
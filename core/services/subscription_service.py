@@ -3,7 +3,8 @@
 """
 
 import asyncio
-from typing import Optional, List, Dict, Any, Tuple
+from contextlib import asynccontextmanager
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable, AsyncIterator
 from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
@@ -14,11 +15,21 @@ from core.database.models import (
 )
 from core.database.repositories import RepositoryManager
 from core.services.user_service import UserService
+from core.services.activity_service import traffic_usage_buffer
 from core.exceptions.custom_exceptions import (
     SubscriptionNotFoundError, InsufficientFundsError, 
     ServerNotAvailableError, SubscriptionExpiredError
 )
 from config.settings import settings
+from config.database import run_in_own_session
+
+
+# Порядок выбора протокола: для российских пользователей и по умолчанию
+_RU_PROTOCOL_PRIORITY = (VpnProtocol.VLESS, VpnProtocol.VMESS, VpnProtocol.TROJAN)
+_DEFAULT_PROTOCOL_PRIORITY = (VpnProtocol.VLESS, VpnProtocol.OPENVPN, VpnProtocol.WIREGUARD)
+
+# Ближайшие страны для российских пользователей в порядке предпочтения
+_RU_PREFERRED_COUNTRIES = ("NL", "DE", "FI", "LV", "EE")
 
 
 class SubscriptionService:
@@ -28,6 +39,25 @@ class SubscriptionService:
         self.session = session
         self.repos = RepositoryManager(session)
         self.user_service = UserService(session)
+        
+        # Активные подписки в пределах запроса (сервис живет вместе с сессией)
+        self._active_subscriptions: Dict[int, Optional[Subscription]] = {}
+    
+    @asynccontextmanager
+    async def _transaction(self) -> AsyncIterator[None]:
+        """
+        Транзакция операции: коммит при успехе, откат при исключении
+        
+        Сбрасывает запомненные активные подписки в любом случае.
+        """
+        try:
+            yield
+            await self.repos.commit()
+        except Exception:
+            await self.repos.rollback()
+            raise
+        finally:
+            self._active_subscriptions.clear()
     
     async def create_subscription(
         self,
@@ -41,69 +71,68 @@ class SubscriptionService:
         Создать новую подписку
         """
         try:
-            # Получаем пользователя и план
-            user = await self.repos.users.get_by_id(user_id)
-            if not user:
-                raise ValueError(f"User {user_id} not found")
-            
-            plan = await self.repos.subscription_plans.get_by_id(plan_id)
-            if not plan:
-                raise ValueError(f"Plan {plan_id} not found")
-            
-            # Выбираем сервер автоматически если не указан
-            if not server_id:
-                server = await self._select_best_server(user, protocol)
-                if not server:
-                    raise ServerNotAvailableError("No available servers")
-                server_id = server.id
-            else:
-                server = await self.repos.servers.get_by_id(server_id)
-                if not server or not server.is_active:
-                    raise ServerNotAvailableError(f"Server {server_id} not available")
-            
-            # Определяем протокол
-            if not protocol:
-                protocol = await self._select_optimal_protocol(user, server)
-            
-            # Проверяем, есть ли активная подписка
-            active_subscription = await self.repos.subscriptions.get_active_subscription(user_id)
-            if active_subscription:
-                # Если есть активная подписка, расширяем её или создаем новую
-                logger.info(f"User {user_id} already has active subscription")
-            
-            # Создаем подписку
-            subscription_data = {
-                "user_id": user_id,
-                "server_id": server_id,
-                "plan_id": plan_id,
-                "active_protocol": protocol,
-                "status": SubscriptionStatus.PENDING,
-                "traffic_limit_gb": plan.traffic_limit_gb,
-                "auto_renewal": False
-            }
-            
-            subscription = await self.repos.subscriptions.create(**subscription_data)
-            
-            # Логируем создание
-            await self.repos.user_activities.log_activity(
-                user_id=user_id,
-                action="subscription_created",
-                details={
-                    "subscription_id": subscription.id,
-                    "plan_name": plan.name,
-                    "server_name": server.name,
-                    "protocol": protocol.value,
-                    "payment_id": payment_id
+            async with self._transaction():
+                # Получаем пользователя и план
+                user = await self.repos.users.get_by_id(user_id)
+                if not user:
+                    raise ValueError(f"User {user_id} not found")
+                
+                plan = await self.repos.subscription_plans.get_cached(plan_id)
+                if not plan:
+                    raise ValueError(f"Plan {plan_id} not found")
+                
+                # Выбираем сервер автоматически если не указан
+                if not server_id:
+                    server = await self._select_best_server(user, protocol)
+                    if not server:
+                        raise ServerNotAvailableError("No available servers")
+                    server_id = server.id
+                else:
+                    server = await self.repos.servers.get_by_id(server_id)
+                    if not server or not server.is_active:
+                        raise ServerNotAvailableError(f"Server {server_id} not available")
+                
+                # Определяем протокол
+                if not protocol:
+                    protocol = await self._select_optimal_protocol(user, server)
+                
+                # Проверяем, есть ли активная подписка: подписки пользователя
+                # уже загружены вместе с ним (lazy="selectin"), без отдельного запроса
+                if any(s.status == SubscriptionStatus.ACTIVE for s in user.subscriptions):
+                    # Если есть активная подписка, расширяем её или создаем новую
+                    logger.info("User {} already has active subscription", user_id)
+                
+                # Создаем подписку
+                subscription_data = {
+                    "user_id": user_id,
+                    "server_id": server_id,
+                    "plan_id": plan_id,
+                    "active_protocol": protocol,
+                    "status": SubscriptionStatus.PENDING,
+                    "traffic_limit_gb": plan.traffic_limit_gb,
+                    "auto_renewal": False
                 }
-            )
+                
+                subscription = await self.repos.subscriptions.create(**subscription_data)
+                
+                # Логируем создание
+                await self.repos.user_activities.log_activity(
+                    user_id=user_id,
+                    action="subscription_created",
+                    details={
+                        "subscription_id": subscription.id,
+                        "plan_name": plan.name,
+                        "server_name": server.name,
+                        "protocol": protocol,
+                        "payment_id": payment_id
+                    }
+                )
             
-            await self.repos.commit()
-            logger.info(f"Subscription created: {subscription.id} for user {user_id}")
+            logger.info("Subscription created: {} for user {}", subscription.id, user_id)
             
             return subscription
             
         except Exception as e:
-            await self.repos.rollback()
             logger.error(f"Error creating subscription: {e}")
             raise
     
@@ -112,41 +141,35 @@ class SubscriptionService:
         Активировать подписку после успешной оплаты
         """
         try:
-            subscription = await self.repos.subscriptions.get_by_id(subscription_id)
-            if not subscription:
-                raise SubscriptionNotFoundError(f"Subscription {subscription_id} not found")
-            
-            # Рассчитываем даты
-            now = datetime.utcnow()
-            plan = subscription.plan
-            expires_at = now + timedelta(days=plan.duration_days)
-            
-            # Обновляем подписку
-            await self.repos.subscriptions.update(
-                subscription_id,
-                status=SubscriptionStatus.ACTIVE,
-                started_at=now,
-                expires_at=expires_at
-            )
-            
-            # Логируем активацию
-            await self.repos.user_activities.log_activity(
-                user_id=subscription.user_id,
-                action="subscription_activated",
-                details={
-                    "subscription_id": subscription_id,
-                    "expires_at": expires_at.isoformat(),
-                    "plan_duration": plan.duration_days
-                }
-            )
+            async with self._transaction():
+                subscription = await self.repos.subscriptions.get_by_id(subscription_id)
+                if not subscription:
+                    raise SubscriptionNotFoundError(f"Subscription {subscription_id} not found")
+                
+                # Рассчитываем даты
+                now = datetime.utcnow()
+                plan = subscription.plan
+                expires_at = now + timedelta(days=plan.duration_days)
+                
+                # Обновляем подписку и логируем активацию одним запросом
+                await self.repos.subscriptions.update_with_activity(
+                    subscription_id,
+                    action="subscription_activated",
+                    details={
+                        "subscription_id": subscription_id,
+                        "expires_at": expires_at,
+                        "plan_duration": plan.duration_days
+                    },
+                    status=SubscriptionStatus.ACTIVE,
+                    started_at=now,
+                    expires_at=expires_at
+                )
             
-            await self.repos.commit()
-            logger.info(f"Subscription {subscription_id} activated")
+            logger.info("Subscription {} activated", subscription_id)
             
             return True
             
         except Exception as e:
-            await self.repos.rollback()
             logger.error(f"Error activating subscription {subscription_id}: {e}")
             return False
     
@@ -160,40 +183,34 @@ class SubscriptionService:
         Продлить подписку
         """
         try:
-            subscription = await self.repos.subscriptions.get_by_id(subscription_id)
-            if not subscription:
-                raise SubscriptionNotFoundError(f"Subscription {subscription_id} not found")
-            
-            # Рассчитываем новую дату окончания
-            current_expires = subscription.expires_at or datetime.utcnow()
-            new_expires = current_expires + timedelta(days=additional_days)
-            
-            # Обновляем подписку
-            await self.repos.subscriptions.update(
-                subscription_id,
-                expires_at=new_expires,
-                status=SubscriptionStatus.ACTIVE if subscription.status == SubscriptionStatus.EXPIRED else subscription.status
-            )
-            
-            # Логируем продление
-            await self.repos.user_activities.log_activity(
-                user_id=subscription.user_id,
-                action="subscription_extended",
-                details={
-                    "subscription_id": subscription_id,
-                    "additional_days": additional_days,
-                    "new_expires_at": new_expires.isoformat(),
-                    "reason": reason
-                }
-            )
+            async with self._transaction():
+                subscription = await self.repos.subscriptions.get_by_id(subscription_id)
+                if not subscription:
+                    raise SubscriptionNotFoundError(f"Subscription {subscription_id} not found")
+                
+                # Рассчитываем новую дату окончания
+                current_expires = subscription.expires_at or datetime.utcnow()
+                new_expires = current_expires + timedelta(days=additional_days)
+                
+                # Обновляем подписку и логируем продление одним запросом
+                await self.repos.subscriptions.update_with_activity(
+                    subscription_id,
+                    action="subscription_extended",
+                    details={
+                        "subscription_id": subscription_id,
+                        "additional_days": additional_days,
+                        "new_expires_at": new_expires,
+                        "reason": reason
+                    },
+                    expires_at=new_expires,
+                    status=SubscriptionStatus.ACTIVE if subscription.status == SubscriptionStatus.EXPIRED else subscription.status
+                )
             
-            await self.repos.commit()
-            logger.info(f"Subscription {subscription_id} extended by {additional_days} days")
+            logger.info("Subscription {} extended by {} days", subscription_id, additional_days)
             
             return True
             
         except Exception as e:
-            await self.repos.rollback()
             logger.error(f"Error extending subscription {subscription_id}: {e}")
             return False
     
@@ -207,32 +224,46 @@ class SubscriptionService:
         Приостановить подписку
         """
         try:
-            success = await self.repos.subscriptions.update_status(
-                subscription_id, SubscriptionStatus.SUSPENDED
-            )
+            async with self._transaction():
+                user_id = await self._suspend_core(subscription_id, reason, admin_id)
+            success = user_id is not None
             
             if success:
-                subscription = await self.repos.subscriptions.get_by_id(subscription_id)
-                await self.repos.user_activities.log_activity(
-                    user_id=subscription.user_id,
-                    action="subscription_suspended",
-                    details={
-                        "subscription_id": subscription_id,
-                        "reason": reason,
-                        "admin_id": admin_id,
-                        "suspended_at": datetime.utcnow().isoformat()
-                    }
-                )
-                await self.repos.commit()
-                logger.info(f"Subscription {subscription_id} suspended")
+                logger.info("Subscription {} suspended", subscription_id)
             
             return success
             
         except Exception as e:
-            await self.repos.rollback()
             logger.error(f"Error suspending subscription {subscription_id}: {e}")
             return False
     
+    async def _suspend_core(
+        self,
+        subscription_id: int,
+        reason: str,
+        admin_id: Optional[int] = None,
+        **values
+    ) -> Optional[int]:
+        """
+        Приостановить подписку без коммита (для использования внутри транзакции)
+        
+        Returns:
+            Optional[int]: ID пользователя или None, если подписка не найдена
+        """
+        # Статус, дополнительные поля и запись активности - одним запросом
+        return await self.repos.subscriptions.update_with_activity(
+            subscription_id,
+            action="subscription_suspended",
+            details={
+                "subscription_id": subscription_id,
+                "reason": reason,
+                "admin_id": admin_id,
+                "suspended_at": datetime.utcnow()
+            },
+            status=SubscriptionStatus.SUSPENDED,
+            **values
+        )
+    
     async def resume_subscription(
         self,
         subscription_id: int,
@@ -242,36 +273,37 @@ class SubscriptionService:
         Возобновить приостановленную подписку
         """
         try:
-            subscription = await self.repos.subscriptions.get_by_id(subscription_id)
-            if not subscription:
-                return False
-            
-            # Проверяем, не истекла ли подписка
-            if subscription.expires_at and subscription.expires_at <= datetime.utcnow():
-                new_status = SubscriptionStatus.EXPIRED
-            else:
-                new_status = SubscriptionStatus.ACTIVE
-            
-            success = await self.repos.subscriptions.update_status(subscription_id, new_status)
-            
-            if success:
-                await self.repos.user_activities.log_activity(
-                    user_id=subscription.user_id,
+            async with self._transaction():
+                subscription = await self.repos.subscriptions.get_by_id(subscription_id)
+                if not subscription:
+                    return False
+                
+                # Проверяем, не истекла ли подписка
+                now = datetime.utcnow()
+                if subscription.expires_at and subscription.expires_at <= now:
+                    new_status = SubscriptionStatus.EXPIRED
+                else:
+                    new_status = SubscriptionStatus.ACTIVE
+                
+                # Статус и запись активности - одним запросом
+                success = await self.repos.subscriptions.update_with_activity(
+                    subscription_id,
                     action="subscription_resumed",
                     details={
                         "subscription_id": subscription_id,
-                        "new_status": new_status.value,
+                        "new_status": new_status,
                         "admin_id": admin_id,
-                        "resumed_at": datetime.utcnow().isoformat()
-                    }
-                )
-                await self.repos.commit()
-                logger.info(f"Subscription {subscription_id} resumed")
+                        "resumed_at": now
+                    },
+                    status=new_status
+                ) is not None
+            
+            if success:
+                logger.info("Subscription {} resumed", subscription_id)
             
             return success
             
         except Exception as e:
-            await self.repos.rollback()
             logger.error(f"Error resuming subscription {subscription_id}: {e}")
             return False
     
@@ -283,18 +315,22 @@ class SubscriptionService:
     
     async def get_active_subscription(self, user_id: int) -> Optional[Subscription]:
         """
-        Получить активную подписку пользователя
+        Получить активную подписку пользователя (запоминается до первого изменения)
         """
-        return await self.repos.subscriptions.get_active_subscription(user_id)
+        if user_id not in self._active_subscriptions:
+            self._active_subscriptions[user_id] = await self.repos.subscriptions.get_active_subscription(user_id)
+        return self._active_subscriptions[user_id]
     
     async def check_subscription_expiry(self, user_id: int) -> Dict[str, Any]:
         """
         Проверить истечение подписки пользователя
         """
         try:
-            subscription = await self.get_active_subscription(user_id)
+            # Статус актуализируется и читается одним запросом
+            async with self._transaction():
+                current = await self.repos.subscriptions.refresh_and_fetch_active(user_id)
             
-            if not subscription:
+            if not current:
                 return {
                     "has_subscription": False,
                     "is_active": False,
@@ -303,8 +339,7 @@ class SubscriptionService:
                     "expired": True
                 }
             
-            now = datetime.utcnow()
-            expires_at = subscription.expires_at
+            status, expires_at = current
             
             if not expires_at:
                 return {
@@ -315,23 +350,16 @@ class SubscriptionService:
                     "expired": False
                 }
             
-            days_left = (expires_at - now).days
-            expired = expires_at <= now
-            
-            # Если подписка истекла, обновляем статус
-            if expired and subscription.status == SubscriptionStatus.ACTIVE:
-                await self.repos.subscriptions.update_status(
-                    subscription.id, SubscriptionStatus.EXPIRED
-                )
-                await self.repos.commit()
+            days_left = (expires_at - datetime.utcnow()).days
+            expired = status == SubscriptionStatus.EXPIRED
             
             return {
                 "has_subscription": True,
-                "is_active": subscription.status == SubscriptionStatus.ACTIVE and not expired,
+                "is_active": status == SubscriptionStatus.ACTIVE,
                 "expires_at": expires_at,
                 "days_left": max(0, days_left),
                 "expired": expired,
-                "status": subscription.status.value
+                "status": status.value
             }
             
         except Exception as e:
@@ -344,49 +372,34 @@ class SubscriptionService:
                 "expired": True
             }
     
-    async def update_traffic_usage(self, subscription_id: int, traffic_gb: float) -> bool:
+    async def expire_due_subscriptions(self) -> int:
         """
-        Обновить использование трафика
+        Перевести истекшие подписки в EXPIRED (фоновая задача)
+        
+        Returns:
+            int: Количество истекших подписок
         """
         try:
-            subscription = await self.repos.subscriptions.get_by_id(subscription_id)
-            if not subscription:
-                return False
+            async with self._transaction():
+                expired_count = await self.repos.subscriptions.expire_due()
             
-            new_traffic = subscription.traffic_used_gb + traffic_gb
-            
-            # Проверяем лимит трафика
-            if subscription.traffic_limit_gb and new_traffic >= subscription.traffic_limit_gb:
-                # Приостанавливаем подписку при превышении лимита
-                await self.suspend_subscription(
-                    subscription_id, 
-                    reason="traffic_limit_exceeded"
-                )
-                
-                await self.repos.user_activities.log_activity(
-                    user_id=subscription.user_id,
-                    action="traffic_limit_exceeded",
-                    details={
-                        "subscription_id": subscription_id,
-                        "traffic_used": new_traffic,
-                        "traffic_limit": subscription.traffic_limit_gb
-                    }
-                )
-            
-            success = await self.repos.subscriptions.update(
-                subscription_id,
-                traffic_used_gb=new_traffic
-            )
-            
-            if success:
-                await self.repos.commit()
-            
-            return success
+            if expired_count:
+                logger.info("Expired {} subscriptions", expired_count)
+            return expired_count
             
         except Exception as e:
-            await self.repos.rollback()
-            logger.error(f"Error updating traffic usage {subscription_id}: {e}")
-            return False
+            logger.error(f"Error expiring subscriptions: {e}")
+            return 0
+    
+    async def update_traffic_usage(self, subscription_id: int, traffic_gb: float) -> bool:
+        """
+        Учесть использованный трафик
+        
+        Приращение копится в traffic_usage_buffer и записывается пачкой
+        вместе с приостановкой подписок, превысивших лимит.
+        """
+        traffic_usage_buffer.add(subscription_id, traffic_gb)
+        return True
     
     async def get_expiring_subscriptions(self, hours: int = 24) -> List[Subscription]:
         """
@@ -394,32 +407,65 @@ class SubscriptionService:
         """
         return await self.repos.subscriptions.get_expiring_subscriptions(hours)
     
+    async def process_expiring(
+        self,
+        handler: Callable[[AsyncSession, Subscription], Awaitable[Any]],
+        hours: int = 24,
+        concurrency: int = 16
+    ) -> int:
+        """
+        Обработать истекающие подписки параллельно
+        
+        Каждый вызов handler получает собственную сессию (одну AsyncSession
+        нельзя использовать конкурентно), число одновременных вызовов
+        ограничено семафором.
+        
+        Args:
+            handler: Корутина handler(session, subscription)
+            hours: Окно истечения в часах
+            concurrency: Максимум одновременных обработчиков
+            
+        Returns:
+            int: Количество успешных обработок (handler вернул истину)
+        """
+        subscriptions = await self.get_expiring_subscriptions(hours)
+        if not subscriptions:
+            return 0
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run(subscription: Subscription):
+            async with semaphore:
+                return await run_in_own_session(
+                    lambda session: handler(session, subscription),
+                    commit=True
+                )
+        
+        results = await asyncio.gather(
+            *(run(subscription) for subscription in subscriptions),
+            return_exceptions=True
+        )
+        
+        processed = 0
+        for subscription, result in zip(subscriptions, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error processing expiring subscription {subscription.id}: {result}")
+            elif result:
+                processed += 1
+        return processed
+    
     async def _select_best_server(self, user: User, protocol: Optional[VpnProtocol] = None) -> Optional[Server]:
         """
         Выбрать лучший сервер для пользователя
         """
         try:
-            # Получаем серверы, поддерживающие нужный протокол
-            if protocol:
-                servers = await self.repos.servers.get_by_protocol(protocol)
-            else:
-                servers = await self.repos.servers.get_all_active()
-            
-            if not servers:
-                return None
-            
             # Для российских пользователей предпочитаем серверы ближайших стран
+            preferred_countries = None
             if user.country_code in settings.RUSSIA_COUNTRY_CODES:
-                # Ищем серверы в приоритетных странах
-                preferred_countries = ["NL", "DE", "FI", "LV", "EE"]
-                for country in preferred_countries:
-                    country_servers = [s for s in servers if s.country_code == country]
-                    if country_servers:
-                        # Выбираем сервер с наименьшей нагрузкой
-                        return min(country_servers, key=lambda s: s.current_users / s.max_users)
+                preferred_countries = _RU_PREFERRED_COUNTRIES
             
-            # Выбираем сервер с наименьшей нагрузкой
-            return min(servers, key=lambda s: s.current_users / s.max_users)
+            # Приоритет стран и наименьшая нагрузка - в одном запросе
+            return await self.repos.servers.select_best(protocol, preferred_countries)
             
         except Exception as e:
             logger.error(f"Error selecting best server: {e}")
@@ -430,25 +476,23 @@ class SubscriptionService:
         Выбрать оптимальный протокол для пользователя и сервера
         """
         try:
+            supported = server.supported_protocols_set
+            
             # Если у пользователя есть предпочтения и автовыбор отключен
             if user.preferred_protocol and not user.auto_select_protocol:
-                if user.preferred_protocol.value in server.supported_protocols:
+                if user.preferred_protocol.value in supported:
                     return user.preferred_protocol
             
             # Для российских пользователей приоритет VLESS
             if user.country_code in settings.RUSSIA_COUNTRY_CODES:
-                for protocol in [VpnProtocol.VLESS, VpnProtocol.VMESS, VpnProtocol.TROJAN]:
-                    if protocol.value in server.supported_protocols:
+                for protocol in _RU_PROTOCOL_PRIORITY:
+                    if protocol.value in supported:
                         return protocol
             
             # По умолчанию выбираем первый доступный протокол
-            supported = server.supported_protocols
-            if "vless" in supported:
-                return VpnProtocol.VLESS
-            elif "openvpn" in supported:
-                return VpnProtocol.OPENVPN
-            elif "wireguard" in supported:
-                return VpnProtocol.WIREGUARD
+            for protocol in _DEFAULT_PROTOCOL_PRIORITY:
+                if protocol.value in supported:
+                    return protocol
             
             # Если ничего не найдено, используем основной протокол сервера
             return server.primary_protocol
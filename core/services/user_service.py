@@ -3,10 +3,14 @@
 """
 
 import asyncio
-from typing import Optional, List, Dict, Any, Tuple
+import time
+from types import MappingProxyType
+from typing import Optional, List, Dict, Any, Tuple, Callable, Mapping, BinaryIO, Iterable, AsyncIterable, Union
 from datetime import datetime, timedelta
+import orjson
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update, func, and_, or_
+from sqlalchemy.orm.attributes import set_committed_value
 from loguru import logger
 
 from core.database.models import (
@@ -14,6 +18,7 @@ from core.database.models import (
     UserActivity, SystemSettings
 )
 from core.database.repositories import RepositoryManager
+from core.services.activity_service import activity_log_buffer
 from core.exceptions.custom_exceptions import (
     UserNotFoundError, UserAlreadyExistsError, 
     UserBannedError, ValidationError
@@ -21,14 +26,111 @@ from core.exceptions.custom_exceptions import (
 from core.utils.helpers import get_country_by_ip, detect_language
 from core.utils.validators import TelegramValidator, UserDataValidator
 from config.settings import settings
+from config.database import run_in_own_session
+
+
+# Роль нужна почти на каждый апдейт, а меняется редко: держим в памяти
+# процесса только скалярные поля по Telegram ID. ORM-объекты не кешируем -
+# их связи (подписки, платежи) устаревали бы вместе с ними
+USER_CACHE_TTL = 30
+USER_CACHE_MAX_SIZE = 10000
+
+_USER_CACHE: Dict[int, Tuple[float, int, UserRole]] = {}  # telegram_id -> (expires_at, user_id, role)
+_USER_CACHE_KEYS: Dict[int, int] = {}  # user_id -> telegram_id
+
+# Не чаще раза в столько секунд пишем last_activity по сообщениям пользователя
+LAST_ACTIVITY_DEBOUNCE = 60
+
+
+def invalidate_user_cache(user_id: Optional[int] = None, telegram_id: Optional[int] = None):
+    """Сбросить кешированного пользователя по ID или Telegram ID"""
+    if telegram_id is None:
+        telegram_id = _USER_CACHE_KEYS.pop(user_id, None)
+    cached = _USER_CACHE.pop(telegram_id, None)
+    if cached:
+        _USER_CACHE_KEYS.pop(cached[1], None)
+
+
+def _cache_user(telegram_id: int, user_id: int, role: UserRole):
+    """Запомнить скалярные поля пользователя на USER_CACHE_TTL"""
+    if telegram_id not in _USER_CACHE and len(_USER_CACHE) >= USER_CACHE_MAX_SIZE:
+        invalidate_user_cache(telegram_id=next(iter(_USER_CACHE)))
+    _USER_CACHE[telegram_id] = (time.monotonic() + USER_CACHE_TTL, user_id, role)
+    _USER_CACHE_KEYS[user_id] = telegram_id
+
+
+# Настройки по умолчанию (только для чтения, общие для всех вызовов)
+DEFAULT_NOTIFICATION_SETTINGS: Mapping[str, bool] = MappingProxyType({
+    "expiry_notifications": True,
+    "maintenance_notifications": True,
+    "news_notifications": False,
+    "security_notifications": True
+})
+
+DEFAULT_PRIVACY_SETTINGS: Mapping[str, bool] = MappingProxyType({
+    "analytics_enabled": True,
+    "error_reporting": True,
+    "usage_statistics": True
+})
+
+
+# Валидаторы предпочтений: возвращают нормализованное значение или _INVALID
+_INVALID = object()
+
+
+def _validate_language(value: Any) -> Any:
+    return value if UserDataValidator.validate_language_code(value) else _INVALID
+
+
+def _validate_protocol(value: Any) -> Any:
+    return value if value is None or isinstance(value, VpnProtocol) else _INVALID
+
+
+_PREF_VALIDATORS: Dict[str, Callable[[Any], Any]] = {
+    "language_code": _validate_language,
+    "preferred_protocol": _validate_protocol,
+    "auto_select_protocol": bool
+}
+
+
+async def _write_json_array(
+    writer: BinaryIO,
+    key: str,
+    records: Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]]
+) -> int:
+    """
+    Дописать в JSON объект поле-массив, сериализуя записи по одной
+    
+    Returns:
+        int: Количество записанных записей
+    """
+    writer.write(b',"' + key.encode() + b'":[')
+    count = 0
+    
+    def write_record(record: Dict[str, Any]):
+        nonlocal count
+        if count:
+            writer.write(b",")
+        writer.write(orjson.dumps(record))
+        count += 1
+    
+    if isinstance(records, AsyncIterable):
+        async for record in records:
+            write_record(record)
+    else:
+        for record in records:
+            write_record(record)
+    
+    writer.write(b"]")
+    return count
 
 
 class UserService:
     """Сервис для управления пользователями"""
     
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, repos: Optional[RepositoryManager] = None):
         self.session = session
-        self.repos = RepositoryManager(session)
+        self.repos = repos or RepositoryManager(session)
     
     async def get_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
         """
@@ -41,7 +143,10 @@ class UserService:
             Optional[User]: Пользователь или None
         """
         try:
-            return await self.repos.users.get_by_telegram_id(telegram_id)
+            user = await self.repos.users.get_by_telegram_id(telegram_id)
+            if user:
+                _cache_user(telegram_id, user.id, user.role)
+            return user
         except Exception as e:
             logger.error(f"Error getting user by telegram_id {telegram_id}: {e}")
             return None
@@ -104,16 +209,26 @@ class UserService:
                 if last_name and last_name != user.last_name:
                     update_data['last_name'] = last_name
                 
-                # Обновляем время последней активности
-                update_data['last_activity'] = datetime.utcnow()
+                # Время последней активности обновляем не чаще раза в
+                # LAST_ACTIVITY_DEBOUNCE секунд, а не на каждое сообщение
+                now = datetime.utcnow()
+                if (
+                    update_data
+                    or user.last_activity is None
+                    or (now - user.last_activity).total_seconds() > LAST_ACTIVITY_DEBOUNCE
+                ):
+                    update_data['last_activity'] = now
                 
                 if update_data:
                     await self.repos.users.update(user.id, **update_data)
                     await self.repos.commit()
+                    invalidate_user_cache(telegram_id=telegram_id)
                     
-                    # Обновляем объект пользователя
+                    # Переносим записанные значения в объект как уже сохраненные:
+                    # setattr пометил бы их измененными и следующий flush
+                    # повторил бы тот же UPDATE
                     for key, value in update_data.items():
-                        setattr(user, key, value)
+                        set_committed_value(user, key, value)
                 
                 return user
             
@@ -140,22 +255,29 @@ class UserService:
                     if country_code in settings.RUSSIA_COUNTRY_CODES:
                         user_data['preferred_protocol'] = VpnProtocol.VLESS
             
-            user = await self.repos.users.create(**user_data)
+            # Параллельный апдейт мог уже создать пользователя: тогда
+            # получаем существующую запись, а не ошибку уникальности
+            user, created = await self.repos.users.insert_or_touch(**user_data)
             
-            # Логируем регистрацию
-            await self.log_user_action(
-                user_id=user.id,
-                action="user_registered",
-                details={
-                    "registration_ip": registration_ip,
-                    "country_code": user_data.get('country_code'),
-                    "language": user_data['language_code']
-                },
-                ip_address=registration_ip
-            )
+            if created:
+                # Логируем регистрацию в той же транзакции: буфер активности
+                # пишет в своей сессии и не увидит незакоммиченного пользователя
+                await self.repos.user_activities.log_activity(
+                    user_id=user.id,
+                    action="user_registered",
+                    details={
+                        "registration_ip": registration_ip,
+                        "country_code": user_data.get('country_code'),
+                        "language": user_data['language_code']
+                    },
+                    ip_address=registration_ip
+                )
             
             await self.repos.commit()
-            logger.info(f"New user created: {user.telegram_id}")
+            if created:
+                logger.info(f"New user created: {user.telegram_id}")
+            else:
+                invalidate_user_cache(telegram_id=telegram_id)
             
             return user
             
@@ -180,34 +302,27 @@ class UserService:
             bool: Успешность обновления
         """
         try:
-            # Валидируем предпочтения
+            # Валидируем предпочтения, неизвестные и невалидные отбрасываем
             validated_prefs = {}
-            
-            if 'language_code' in preferences:
-                lang = preferences['language_code']
-                if UserDataValidator.validate_language_code(lang):
-                    validated_prefs['language_code'] = lang
-            
-            if 'preferred_protocol' in preferences:
-                protocol = preferences['preferred_protocol']
-                if protocol is None or isinstance(protocol, VpnProtocol):
-                    validated_prefs['preferred_protocol'] = protocol
-            
-            if 'auto_select_protocol' in preferences:
-                validated_prefs['auto_select_protocol'] = bool(preferences['auto_select_protocol'])
+            for key in preferences.keys() & _PREF_VALIDATORS.keys():
+                value = _PREF_VALIDATORS[key](preferences[key])
+                if value is not _INVALID:
+                    validated_prefs[key] = value
             
             if not validated_prefs:
                 return False
             
-            success = await self.repos.users.update(user_id, **validated_prefs)
+            # Обновление и запись активности - одним запросом
+            success = await self.repos.users.update_with_activity(
+                user_id,
+                action="preferences_updated",
+                details=validated_prefs,
+                **validated_prefs
+            ) is not None
             
             if success:
-                await self.log_user_action(
-                    user_id=user_id,
-                    action="preferences_updated",
-                    details=validated_prefs
-                )
                 await self.repos.commit()
+                invalidate_user_cache(user_id)
             
             return success
             
@@ -234,23 +349,21 @@ class UserService:
             bool: Успешность блокировки
         """
         try:
-            success = await self.repos.users.update(
+            success = await self.repos.users.update_with_activity(
                 user_id,
+                action="user_banned",
+                # Время действия - created_at записи активности
+                details={
+                    "reason": reason,
+                    "admin_id": admin_id
+                },
                 is_banned=True,
                 is_active=False
-            )
+            ) is not None
             
             if success:
-                await self.log_user_action(
-                    user_id=user_id,
-                    action="user_banned",
-                    details={
-                        "reason": reason,
-                        "admin_id": admin_id,
-                        "banned_at": datetime.utcnow().isoformat()
-                    }
-                )
                 await self.repos.commit()
+                invalidate_user_cache(user_id)
                 logger.info(f"User {user_id} banned by admin {admin_id}: {reason}")
             
             return success
@@ -276,22 +389,17 @@ class UserService:
             bool: Успешность разблокировки
         """
         try:
-            success = await self.repos.users.update(
+            success = await self.repos.users.update_with_activity(
                 user_id,
+                action="user_unbanned",
+                details={"admin_id": admin_id},
                 is_banned=False,
                 is_active=True
-            )
+            ) is not None
             
             if success:
-                await self.log_user_action(
-                    user_id=user_id,
-                    action="user_unbanned",
-                    details={
-                        "admin_id": admin_id,
-                        "unbanned_at": datetime.utcnow().isoformat()
-                    }
-                )
                 await self.repos.commit()
+                invalidate_user_cache(user_id)
                 logger.info(f"User {user_id} unbanned by admin {admin_id}")
             
             return success
@@ -325,7 +433,7 @@ class UserService:
             
             # Проверяем режим технического обслуживания
             if user.role != UserRole.ADMIN:
-                maintenance_mode = await self.repos.system_settings.get_setting("maintenance_mode")
+                maintenance_mode = await self.repos.system_settings.get_cached_setting("maintenance_mode")
                 if maintenance_mode == "true":
                     return False, "Сервис временно недоступен. Ведутся технические работы."
             
@@ -346,6 +454,9 @@ class UserService:
         """
         Логировать действие пользователя
         
+        Запись ставится в буфер активности и пишется пачкой в фоне,
+        не дожидаясь INSERT и коммита вызывающего.
+        
         Args:
             user_id: ID пользователя
             action: Действие
@@ -354,10 +465,10 @@ class UserService:
             user_agent: User Agent
         """
         try:
-            await self.repos.user_activities.log_activity(
-                user_id=user_id,
-                action=action,
-                details=details,
+            activity_log_buffer.enqueue(
+                user_id,
+                action,
+                details,
                 ip_address=ip_address,
                 user_agent=user_agent
             )
@@ -375,27 +486,25 @@ class UserService:
             Dict[str, Any]: Статистика пользователя
         """
         try:
-            user = await self.repos.users.get_by_id(user_id)
+            # Пользователь, подписки (с конфигурациями) и активность - параллельно
+            user, subscriptions, activities = await asyncio.gather(
+                run_in_own_session(lambda s: RepositoryManager(s).users.get_by_id(user_id)),
+                run_in_own_session(lambda s: RepositoryManager(s).subscriptions.get_user_subscriptions(user_id)),
+                run_in_own_session(lambda s: RepositoryManager(s).user_activities.get_user_activities(user_id, 100))
+            )
             if not user:
                 return {}
             
-            # Получаем подписки
-            subscriptions = await self.repos.subscriptions.get_user_subscriptions(user_id)
-            
             # Получаем конфигурации
             total_configs = 0
             total_traffic = 0.0
             
             for subscription in subscriptions:
-                configs = await self.repos.vpn_configs.get_by_subscription(subscription.id)
-                total_configs += len(configs)
+                total_configs += len(subscription.vpn_configs)
                 
-                for config in configs:
+                for config in subscription.vpn_configs:
                     total_traffic += config.total_traffic_gb
             
-            # Получаем активность
-            activities = await self.repos.user_activities.get_user_activities(user_id, 100)
-            
             return {
                 "user_id": user_id,
                 "telegram_id": user.telegram_id,
@@ -432,90 +541,63 @@ class UserService:
             # Получаем активность за последние месяцы
             monthly_stats = []
             current_date = datetime.utcnow()
+            month_start = current_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            months = []
+            for _ in range(6):  # Последние 6 календарных месяцев
+                months.append(month_start)
+                month_start = (month_start - timedelta(days=1)).replace(day=1)
+            
+            # Счетчики по месяцам считает БД (date_trunc + GROUP BY)
+            monthly_counts = await self.repos.user_activities.get_monthly_counts(
+                user_id,
+                "config_downloaded",  # Пример активности
+                since=months[-1]
+            )
             
-            for i in range(6):  # Последние 6 месяцев
-                month_start = current_date.replace(day=1) - timedelta(days=i*30)
-                month_end = month_start + timedelta(days=30)
-                
-                activities = await self.repos.user_activities.get_activities_by_action(
-                    "config_downloaded",  # Пример активности
-                    days=30
-                )
-                
-                month_activities = [
-                    a for a in activities 
-                    if month_start <= a.created_at <= month_end and a.user_id == user_id
-                ]
-                
+            for month_start in months:
+                month = month_start.strftime("%Y-%m")
                 monthly_stats.append({
-                    "month": month_start.strftime("%Y-%m"),
-                    "activities": len(month_activities),
+                    "month": month,
+                    "activities": monthly_counts.get(month, 0),
                     "traffic_gb": 0.0  # Здесь можно добавить расчет трафика за месяц
                 })
             
-            # Статистика по серверам
-            subscriptions = await self.repos.subscriptions.get_user_subscriptions(user_id)
-            server_stats = {}
-            
-            for subscription in subscriptions:
-                server_name = subscription.server.name
-                if server_name not in server_stats:
-                    server_stats[server_name] = {
-                        "server_name": server_name,
-                        "sessions": 0,
-                        "traffic_gb": 0.0
-                    }
-                
-                server_stats[server_name]["sessions"] += 1
-                
-                configs = await self.repos.vpn_configs.get_by_subscription(subscription.id)
-                for config in configs:
-                    server_stats[server_name]["traffic_gb"] += config.total_traffic_gb
-            
-            # Статистика по протоколам
-            protocol_stats = {}
-            all_configs = []
+            # Статистика по серверам, протоколам и активности за неделю -
+            # агрегатами в БД, без запросов на каждую подписку и день
+            server_stats = [
+                {
+                    "server_name": server_name,
+                    "sessions": sessions,
+                    "traffic_gb": float(traffic_gb)
+                }
+                for server_name, sessions, traffic_gb
+                in await self.repos.subscriptions.get_user_server_stats(user_id)
+            ]
             
-            for subscription in subscriptions:
-                configs = await self.repos.vpn_configs.get_by_subscription(subscription.id)
-                all_configs.extend(configs)
-            
-            total_configs = len(all_configs)
-            if total_configs > 0:
-                for config in all_configs:
-                    protocol = config.protocol.value
-                    if protocol not in protocol_stats:
-                        protocol_stats[protocol] = 0
-                    protocol_stats[protocol] += 1
-                
-                # Преобразуем в проценты
-                protocol_stats = {
-                    protocol: {
-                        "protocol": protocol,
-                        "usage_percent": (count / total_configs) * 100
-                    }
-                    for protocol, count in protocol_stats.items()
+            protocol_counts = await self.repos.subscriptions.get_user_protocol_counts(user_id)
+            total_configs = sum(protocol_counts.values())
+            protocol_stats = [
+                {
+                    "protocol": protocol.value,
+                    "usage_percent": (count / total_configs) * 100
                 }
+                for protocol, count in protocol_counts.items()
+            ]
             
-            # Активность за неделю
+            daily_counts = await self.repos.user_activities.get_daily_counts(user_id, days=7)
             week_activity = []
             for i in range(7):
                 day = current_date.date() - timedelta(days=i)
-                day_activities = [
-                    a for a in await self.repos.user_activities.get_user_activities(user_id, 100)
-                    if a.created_at.date() == day
-                ]
-                
                 week_activity.append({
                     "date": day.isoformat(),
-                    "actions": len(day_activities)
+                    "actions": daily_counts.get(day, 0)
                 })
             
             return {
                 **basic_stats,
                 "monthly_stats": monthly_stats,
-                "server_stats": list(server_stats.values()),
-                "protocol_stats": list(protocol_stats.values()),
+                "server_stats": server_stats,
+                "protocol_stats": protocol_stats,
                 "week_activity": week_activity
             }
             
@@ -523,7 +605,7 @@ class UserService:
             logger.error(f"Error getting detailed user statistics {user_id}: {e}")
             return {}
     
-    async def get_notification_settings(self, user_id: int) -> Dict[str, bool]:
+    async def get_notification_settings(self, user_id: int) -> Mapping[str, bool]:
         """
         Получить настройки уведомлений пользователя
         
@@ -531,20 +613,11 @@ class UserService:
             user_id: ID пользователя
             
         Returns:
-            Dict[str, bool]: Настройки уведомлений
+            Mapping[str, bool]: Настройки уведомлений (только для чтения)
         """
-        try:
-            # В реальной системе это могло бы быть отдельной таблицей
-            # Пока возвращаем настройки по умолчанию
-            return {
-                "expiry_notifications": True,
-                "maintenance_notifications": True,
-                "news_notifications": False,
-                "security_notifications": True
-            }
-        except Exception as e:
-            logger.error(f"Error getting notification settings {user_id}: {e}")
-            return {}
+        # В реальной системе это могло бы быть отдельной таблицей
+        # Пока возвращаем настройки по умолчанию
+        return DEFAULT_NOTIFICATION_SETTINGS
     
     async def update_notification_settings(
         self,
@@ -573,7 +646,7 @@ class UserService:
             logger.error(f"Error updating notification settings {user_id}: {e}")
             return False
     
-    async def get_privacy_settings(self, user_id: int) -> Dict[str, bool]:
+    async def get_privacy_settings(self, user_id: int) -> Mapping[str, bool]:
         """
         Получить настройки приватности
         
@@ -581,17 +654,9 @@ class UserService:
             user_id: ID пользователя
             
         Returns:
-            Dict[str, bool]: Настройки приватности
+            Mapping[str, bool]: Настройки приватности (только для чтения)
         """
-        try:
-            return {
-                "analytics_enabled": True,
-                "error_reporting": True,
-                "usage_statistics": True
-            }
-        except Exception as e:
-            logger.error(f"Error getting privacy settings {user_id}: {e}")
-            return {}
+        return DEFAULT_PRIVACY_SETTINGS
     
     async def update_privacy_settings(
         self,
@@ -619,113 +684,115 @@ class UserService:
             logger.error(f"Error updating privacy settings {user_id}: {e}")
             return False
     
-    async def export_user_data(self, user_id: int) -> Dict[str, Any]:
+    async def export_user_data(self, user_id: int, writer: BinaryIO) -> bool:
         """
-        Экспортировать данные пользователя
+        Экспортировать данные пользователя в JSON
+        
+        Документ пишется по одной записи, без сборки разделов в памяти;
+        платежи читаются серверным курсором и сразу сериализуются.
         
         Args:
             user_id: ID пользователя
+            writer: Бинарный поток для записи (например, файл)
             
         Returns:
-            Dict[str, Any]: Все данные пользователя
+            bool: Успешность экспорта
         """
         try:
-            user = await self.repos.users.get_by_id(user_id)
+            # Независимые выборки - параллельно, каждая в своей сессии
+            user, subscriptions, activities = await asyncio.gather(
+                run_in_own_session(lambda s: RepositoryManager(s).users.get_by_id(user_id)),
+                run_in_own_session(lambda s: RepositoryManager(s).subscriptions.get_user_subscriptions(user_id)),
+                run_in_own_session(lambda s: RepositoryManager(s).user_activities.get_user_activities(user_id, 100))
+            )
             if not user:
-                return {}
+                return False
             
             # Базовая информация о пользователе
-            user_data = {
-                "user_profile": {
-                    "telegram_id": user.telegram_id,
-                    "username": user.username,
-                    "first_name": user.first_name,
-                    "last_name": user.last_name,
-                    "language_code": user.language_code,
-                    "country_code": user.country_code,
-                    "registration_date": user.created_at.isoformat(),
-                    "last_activity": user.last_activity.isoformat() if user.last_activity else None,
-                    "preferred_protocol": user.preferred_protocol.value if user.preferred_protocol else None,
-                    "auto_select_protocol": user.auto_select_protocol
-                }
-            }
+            writer.write(b'{"user_profile":')
+            writer.write(orjson.dumps({
+                "telegram_id": user.telegram_id,
+                "username": user.username,
+                "first_name": user.first_name,
+                "last_name": user.last_name,
+                "language_code": user.language_code,
+                "country_code": user.country_code,
+                "registration_date": user.created_at,
+                "last_activity": user.last_activity,
+                "preferred_protocol": user.preferred_protocol,
+                "auto_select_protocol": user.auto_select_protocol
+            }))
+            
+            total_records = {}
             
             # Подписки
-            subscriptions = await self.repos.subscriptions.get_user_subscriptions(user_id)
-            user_data["subscriptions"] = [
+            total_records["subscriptions"] = await _write_json_array(writer, "subscriptions", (
                 {
                     "id": sub.id,
                     "plan_name": sub.plan.name,
                     "server_name": sub.server.name,
-                    "status": sub.status.value,
-                    "started_at": sub.started_at.isoformat() if sub.started_at else None,
-                    "expires_at": sub.expires_at.isoformat() if sub.expires_at else None,
+                    "status": sub.status,
+                    "started_at": sub.started_at,
+                    "expires_at": sub.expires_at,
                     "traffic_used_gb": float(sub.traffic_used_gb),
                     "traffic_limit_gb": sub.traffic_limit_gb
                 }
                 for sub in subscriptions
-            ]
+            ))
             
             # VPN конфигурации (без чувствительных данных)
-            all_configs = []
-            for subscription in subscriptions:
-                configs = await self.repos.vpn_configs.get_by_subscription(subscription.id)
-                for config in configs:
-                    all_configs.append({
-                        "id": config.id,
-                        "protocol": config.protocol.value,
-                        "server_name": config.server.name,
-                        "is_active": config.is_active,
-                        "total_traffic_gb": float(config.total_traffic_gb),
-                        "last_used": config.last_used.isoformat() if config.last_used else None,
-                        "created_at": config.created_at.isoformat()
-                    })
-            
-            user_data["vpn_configurations"] = all_configs
+            total_records["configurations"] = await _write_json_array(writer, "vpn_configurations", (
+                {
+                    "id": config.id,
+                    "protocol": config.protocol,
+                    "server_name": config.server.name,
+                    "is_active": config.is_active,
+                    "total_traffic_gb": float(config.total_traffic_gb),
+                    "last_used": config.last_used,
+                    "created_at": config.created_at
+                }
+                for subscription in subscriptions
+                for config in subscription.vpn_configs
+            ))
             
             # История активности (последние 100 записей)
-            activities = await self.repos.user_activities.get_user_activities(user_id, 100)
-            user_data["activity_history"] = [
+            total_records["activities"] = await _write_json_array(writer, "activity_history", (
                 {
                     "action": activity.action,
                     "details": activity.details,
-                    "created_at": activity.created_at.isoformat(),
+                    "created_at": activity.created_at,
                     "ip_address": activity.ip_address
                 }
                 for activity in activities
-            ]
+            ))
             
-            # Платежи
-            payments = await self.repos.payments.get_user_payments(user_id)
-            user_data["payments"] = [
+            # Платежи (потоково, без загрузки всех объектов разом)
+            total_records["payments"] = await _write_json_array(writer, "payments", (
                 {
                     "id": payment.id,
                     "amount": float(payment.amount),
                     "currency": payment.currency,
-                    "status": payment.status.value,
-                    "created_at": payment.created_at.isoformat(),
-                    "paid_at": payment.paid_at.isoformat() if payment.paid_at else None
+                    "status": payment.status,
+                    "created_at": payment.created_at,
+                    "paid_at": payment.paid_at
                 }
-                for payment in payments
-            ]
+                async for payment in self.repos.payments.stream_user_payments(user_id)
+            ))
             
             # Метаданные экспорта
-            user_data["export_info"] = {
-                "exported_at": datetime.utcnow().isoformat(),
+            writer.write(b',"export_info":')
+            writer.write(orjson.dumps({
+                "exported_at": datetime.utcnow(),
                 "export_version": "1.0",
-                "total_records": {
-                    "subscriptions": len(user_data["subscriptions"]),
-                    "configurations": len(user_data["vpn_configurations"]),
-                    "activities": len(user_data["activity_history"]),
-                    "payments": len(user_data["payments"])
-                }
-            }
+                "total_records": total_records
+            }))
+            writer.write(b"}")
             
-            return user_data
+            return True
             
         except Exception as e:
             logger.error(f"Error exporting user data {user_id}: {e}")
-            return {}
+            return False
     
     async def delete_user_data(self, user_id: int) -> bool:
         """
@@ -742,22 +809,20 @@ class UserService:
             # или помечание записей как удаленных для соблюдения GDPR
             
             # Деактивируем пользователя
-            success = await self.repos.users.update(
+            success = await self.repos.users.update_with_activity(
                 user_id,
+                action="user_data_deleted",
+                details=None,
                 is_active=False,
                 is_banned=True,
                 username=None,
                 first_name="[DELETED]",
                 last_name=None
-            )
+            ) is not None
             
             if success:
-                await self.log_user_action(
-                    user_id=user_id,
-                    action="user_data_deleted",
-                    details={"deleted_at": datetime.utcnow().isoformat()}
-                )
                 await self.repos.commit()
+                invalidate_user_cache(user_id)
                 logger.info(f"User data deleted: {user_id}")
             
             return success
@@ -820,14 +885,15 @@ class UserService:
             Dict[str, int]: Статистика пользователей
         """
         try:
-            total_users = await self.repos.users.get_active_users_count()
+            today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            counts = await self.repos.users.get_users_counts(new_since=today)
             
-            # Можно добавить больше метрик
             return {
-                "total_users": total_users,
-                "active_users": total_users,  # Упрощение
-                "banned_users": 0,  # Нужно добавить в репозиторий
-                "new_today": 0  # Нужно добавить в репозиторий
+                "total_users": counts.get("total_users", 0),
+                "active_users": counts.get("active_users", 0),
+                "banned_users": counts.get("banned_users", 0),
+                "admins": counts.get("admins", 0),
+                "new_today": counts.get("new_today", 0)
             }
             
         except Exception as e:
@@ -887,10 +953,7 @@ class UserNotificationService:
             await self.user_service.log_user_action(
                 user_id=user_id,
                 action="welcome_message_sent",
-                details={
-                    "notification_type": "welcome",
-                    "sent_at": datetime.utcnow().isoformat()
-                }
+                details={"notification_type": "welcome"}
             )
             
             logger.info(f"Welcome message sent to user {user_id}")
@@ -911,19 +974,28 @@ class UserNotificationService:
             maintenance_info: Информация о техобслуживании
         """
         try:
-            for user_id in user_ids:
-                await self.user_service.log_user_action(
-                    user_id=user_id,
-                    action="maintenance_notification_sent",
-                    details={
-                        "notification_type": "maintenance",
-                        "maintenance_info": maintenance_info
-                    }
-                )
+            # Рассылка идет на тысячи пользователей: пишем всю пачку одним
+            # INSERT, а не по записи в буфер активности на каждого
+            details = {
+                "notification_type": "maintenance",
+                "maintenance_info": maintenance_info
+            }
+            now = datetime.utcnow()
+            await self.repos.user_activities.log_activities_bulk([
+                {
+                    "user_id": user_id,
+                    "action": "maintenance_notification_sent",
+                    "details": details,
+                    "created_at": now
+                }
+                for user_id in user_ids
+            ])
+            await self.repos.commit()
             
             logger.info(f"Maintenance notification sent to {len(user_ids)} users")
             
         except Exception as e:
+            await self.repos.rollback()
             logger.error(f"Error sending maintenance notification: {e}")
 
 
@@ -976,36 +1048,24 @@ class UserAnalyticsService:
             Dict[str, Any]: Статистика активности
         """
         try:
-            # Получаем активность за последние дни
-            activities = await self.repos.user_activities.get_activities_by_action(
-                "user_login",  # Пример действия
-                days=days
-            )
+            # Все действия за период одним запросом, сгруппированные по дню и типу
+            since = datetime.utcnow() - timedelta(days=days)
+            rows = await self.repos.user_activities.get_daily_action_counts(since)
             
-            # Группируем по дням
             daily_activity = {}
-            for activity in activities:
-                day = activity.created_at.date()
-                if day not in daily_activity:
-                    daily_activity[day] = 0
-                daily_activity[day] += 1
-            
-            # Самые популярные действия
-            all_activities = []
-            for i in range(days):
-                day_activities = await self.repos.user_activities.get_activities_by_action(
-                    "any",  # Все действия (нужно доработать в репозитории)
-                    days=1
-                )
-                all_activities.extend(day_activities)
+            total_activities = 0
+            for day, action, count in rows:
+                total_activities += count
+                if action == "user_login":  # Пример действия
+                    daily_activity[day] = count
             
             return {
                 "period_days": days,
-                "total_activities": len(all_activities),
+                "total_activities": total_activities,
                 "daily_breakdown": {
                     str(day): count for day, count in daily_activity.items()
                 },
-                "average_daily_activity": len(all_activities) / days if days > 0 else 0,
+                "average_daily_activity": total_activities / days if days > 0 else 0,
                 "peak_activity_day": max(daily_activity.items(), key=lambda x: x[1])[0].isoformat() if daily_activity else None
             }
             
@@ -1041,6 +1101,14 @@ class UserAnalyticsService:
 
 # Вспомогательные функции для удобства использования
 
+def _get_user_service(session: AsyncSession) -> UserService:
+    """Сервис пользователей, один на сессию (хранится в session.info)"""
+    user_service = session.info.get("user_service")
+    if user_service is None:
+        user_service = session.info["user_service"] = UserService(session)
+    return user_service
+
+
 async def get_user_by_telegram_id(session: AsyncSession, telegram_id: int) -> Optional[User]:
     """
     Быстрая функция для получения пользователя по Telegram ID
@@ -1052,7 +1120,7 @@ async def get_user_by_telegram_id(session: AsyncSession, telegram_id: int) -> Op
     Returns:
         Optional[User]: Пользователь или None
     """
-    user_service = UserService(session)
+    user_service = _get_user_service(session)
     return await user_service.get_user_by_telegram_id(telegram_id)
 
 
@@ -1072,7 +1140,7 @@ async def create_user_if_not_exists(
     Returns:
         User: Пользователь
     """
-    user_service = UserService(session)
+    user_service = _get_user_service(session)
     return await user_service.get_or_create_user(telegram_id, **user_data)
 
 
@@ -1092,17 +1160,22 @@ async def check_user_permissions(
     Returns:
         bool: Есть ли права
     """
-    user_service = UserService(session)
-    user = await user_service.get_user_by_telegram_id(telegram_id)
-    
-    if not user:
-        return False
+    # Роль берем из кеша пользователей, иначе читаем ID и роль, не загружая User
+    cached = _USER_CACHE.get(telegram_id)
+    if cached is not None and cached[0] > time.monotonic():
+        role = cached[2]
+    else:
+        row = await RepositoryManager(session).users.get_id_and_role_by_telegram_id(telegram_id)
+        if row is None:
+            return False
+        user_id, role = row
+        _cache_user(telegram_id, user_id, role)
     
     # Проверяем роль (админы имеют доступ ко всему)
-    if user.role == UserRole.ADMIN:
+    if role == UserRole.ADMIN:
         return True
     
-    return user.role == required_role
+    return role == required_role
 
 
 async def log_user_action_simple(
@@ -1120,7 +1193,7 @@ async def log_user_action_simple(
         action: Действие
         details: Детали действия
     """
-    user_service = UserService(session)
+    user_service = _get_user_service(session)
     user = await user_service.get_user_by_telegram_id(telegram_id)
     
     if user:
@@ -1204,7 +1277,7 @@ def log_user_action(action: str):
                     user_id = kwargs['user_id']
                 
                 if session and user_id:
-                    user_service = UserService(session)
+                    user_service = _get_user_service(session)
                     await user_service.log_user_action(
                         user_id=user_id,
                         action=action,
@@ -2,9 +2,21 @@
 Базовый сервис для работы с VPN протоколами
 """
 
+import asyncio
+import base64
+import hashlib
+import ipaddress
+import os
+import re
+import secrets
+import tempfile
+import time
+import uuid
 from abc import ABC, abstractmethod
+from io import BytesIO
+from urllib.parse import quote_plus
 from typing import Dict, Any, Optional, List
-from datetime import datetime
+import qrcode
 from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
 
@@ -16,6 +28,51 @@ from core.exceptions.vpn_exceptions import (
 )
 
 
+# Недопустимые символы в имени клиента
+_CLIENT_NAME_RE = re.compile(r'[^a-zA-Z0-9_-]')
+
+# Параметры, которые идут в адрес и фрагмент URL, а не в query
+_URL_RESERVED_PARAMS = frozenset({"address", "port", "fragment"})
+
+
+def _render_qr_png(data: str) -> bytes:
+    """Отрисовать QR код в PNG (синхронно, вызывается в отдельном потоке)"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    
+    buffer = BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _write_file(filepath: str, content: bytes):
+    """
+    Атомарно записать файл, создав каталог при необходимости
+    
+    Пишем во временный файл рядом и переименовываем: по итоговому пути
+    никогда не лежит недописанный файл.
+    """
+    directory = os.path.dirname(filepath)
+    os.makedirs(directory, exist_ok=True)
+    
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 class BaseVpnService(ABC):
     """
     Абстрактный базовый класс для всех VPN сервисов
@@ -144,7 +201,7 @@ class BaseVpnService(ABC):
         """
         try:
             # Проверяем, поддерживает ли сервер протокол
-            if self.protocol.value not in self.server.supported_protocols:
+            if self.protocol.value not in self.server.supported_protocols_set:
                 raise VpnProtocolNotSupportedError(
                     f"Server {self.server.id} doesn't support {self.protocol.value}"
                 )
@@ -171,9 +228,8 @@ class BaseVpnService(ABC):
         Returns:
             str: Уникальный ID клиента
         """
-        import uuid
-        timestamp = int(datetime.utcnow().timestamp())
-        unique_id = str(uuid.uuid4())[:8]
+        timestamp = int(time.time())
+        unique_id = secrets.token_hex(4)
         return f"{self.protocol.value}_{subscription_id}_{timestamp}_{unique_id}"
     
     async def log_config_action(
@@ -285,6 +341,12 @@ class BaseVpnService(ABC):
             logger.error(f"Error deactivating config {config_id}: {e}")
             return False
     
+    def _is_overloaded(self) -> bool:
+        """Загружен ли сервер более чем на 90% (по уже загруженным полям сервера)"""
+        if not self.server.max_users:
+            return True
+        return self.server.current_users * 100 > self.server.max_users * 90
+    
     async def get_server_load(self) -> Dict[str, Any]:
         """
         Получить загрузку сервера
@@ -302,7 +364,7 @@ class BaseVpnService(ABC):
                 "cpu_usage": float(self.server.cpu_usage),
                 "memory_usage": float(self.server.memory_usage),
                 "disk_usage": float(self.server.disk_usage),
-                "is_overloaded": load_percentage > 90
+                "is_overloaded": self._is_overloaded()
             }
             
         except Exception as e:
@@ -317,8 +379,7 @@ class BaseVpnService(ABC):
             bool: Доступность места
         """
         try:
-            load_info = await self.get_server_load()
-            return not load_info.get("is_overloaded", True)
+            return not self._is_overloaded()
             
         except Exception as e:
             logger.error(f"Error checking server capacity: {e}")
@@ -332,17 +393,14 @@ class VpnServiceMixin:
     
     def generate_uuid(self) -> str:
         """Генерировать UUID"""
-        import uuid
         return str(uuid.uuid4())
     
     def encode_base64(self, data: str) -> str:
         """Кодировать в base64"""
-        import base64
         return base64.b64encode(data.encode()).decode()
     
     def decode_base64(self, data: str) -> str:
         """Декодировать из base64"""
-        import base64
         return base64.b64decode(data.encode()).decode()
     
     def format_connection_url(self, protocol: str, params: Dict[str, Any]) -> str:
@@ -357,28 +415,20 @@ class VpnServiceMixin:
             str: URL подключения
         """
         try:
-            import urllib.parse
-            
-            # Базовая структура URL
-            url_parts = {
-                "scheme": protocol,
-                "netloc": f"{params.get('address', '')}:{params.get('port', '')}",
-                "path": "",
-                "params": "",
-                "query": "",
-                "fragment": params.get('fragment', '')
-            }
-            
-            # Добавляем параметры в query
-            query_params = {}
-            for key, value in params.items():
-                if key not in ["address", "port", "fragment"] and value is not None:
-                    query_params[key] = str(value)
-            
-            url_parts["query"] = urllib.parse.urlencode(query_params)
+            # Собираем URL напрямую, без разбора/сборки через urlunparse;
+            # кодирование параметров - как в urllib.parse.urlencode
+            query = "&".join(
+                f"{quote_plus(key, safe='')}={quote_plus(str(value), safe='')}"
+                for key, value in params.items()
+                if key not in _URL_RESERVED_PARAMS and value is not None
+            )
             
-            # Собираем URL
-            url = urllib.parse.urlunparse(tuple(url_parts.values()))
+            url = f"{protocol}://{params.get('address', '')}:{params.get('port', '')}"
+            if query:
+                url += f"?{query}"
+            fragment = params.get('fragment', '')
+            if fragment:
+                url += f"#{fragment}"
             
             return url
             
@@ -398,32 +448,18 @@ class VpnServiceMixin:
             Optional[str]: Путь к файлу QR кода
         """
         try:
-            import qrcode
-            from io import BytesIO
-            from PIL import Image
-            import os
-            
-            # Создаем QR код
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(connection_string)
-            qr.make(fit=True)
-            
-            # Создаем изображение
-            qr_image = qr.make_image(fill_color="black", back_color="white")
-            
-            # Сохраняем файл
-            filename = f"qr_config_{config_id}.png"
-            filepath = f"static/qr_codes/{filename}"
-            
-            os.makedirs("static/qr_codes", exist_ok=True)
-            qr_image.save(filepath)
-            
-            logger.info(f"QR code generated: {filepath}")
+            # Имя файла - хеш строки подключения: для той же строки
+            # уже отрисованный QR код переиспользуется
+            digest = hashlib.sha1(connection_string.encode()).hexdigest()[:16]
+            filepath = f"static/qr_codes/qr_{digest}.png"
+            if os.path.exists(filepath):
+                return filepath
+            
+            # Рендеринг PNG и запись файла блокируют поток - выносим из event loop
+            png = await asyncio.to_thread(_render_qr_png, connection_string)
+            await asyncio.to_thread(_write_file, filepath, png)
+            
+            logger.info(f"QR code generated for config {config_id}: {filepath}")
             return filepath
             
         except Exception as e:
@@ -440,7 +476,6 @@ class VpnServiceMixin:
         Returns:
             bool: Валидность IP
         """
-        import ipaddress
         try:
             ipaddress.ip_address(ip)
             return True
@@ -469,8 +504,7 @@ class VpnServiceMixin:
         Returns:
             str: Очищенное имя
         """
-        import re
         # Оставляем только буквы, цифры, дефисы и подчеркивания
-        sanitized = re.sub(r'[^a-zA-Z0-9_-]', '', name)
+        sanitized = _CLIENT_NAME_RE.sub('', name)
         # Ограничиваем длину
         return sanitized[:50] if sanitized else "client"
\ No newline at end of file
@@ -3,15 +3,32 @@
 """
 
 import re
+import time
 import asyncio
 import aiohttp
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta
 from loguru import logger
 
 from config.settings import settings
 
 
+# Страна по подсети /24: соседние адреса почти всегда в одной стране,
+# а хранится только префикс, не адрес пользователя
+GEOIP_CACHE_TTL = 6 * 3600
+GEOIP_CACHE_MAX_SIZE = 20000
+
+_GEOIP_CACHE: Dict[str, Tuple[float, str]] = {}
+
+
+def _geoip_cache_key(ip_address: str) -> str:
+    """Ключ кеша: подсеть /24 для IPv4, сам адрес для остальных"""
+    parts = ip_address.split(".")
+    if len(parts) == 4:
+        return ".".join(parts[:3])
+    return ip_address
+
+
 async def get_country_by_ip(ip_address: str) -> Optional[str]:
     """
     Определить страну по IP адресу
@@ -22,6 +39,11 @@ async def get_country_by_ip(ip_address: str) -> Optional[str]:
     Returns:
         Optional[str]: Код страны или None
     """
+    cache_key = _geoip_cache_key(ip_address)
+    cached = _GEOIP_CACHE.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
     try:
         # Используем бесплатный API для определения страны
         async with aiohttp.ClientSession() as session:
@@ -31,7 +53,14 @@ async def get_country_by_ip(ip_address: str) -> Optional[str]:
             ) as response:
                 if response.status == 200:
                     data = await response.json()
-                    return data.get("countryCode")
+                    country_code = data.get("countryCode")
+                    
+                    # Кешируем только успешные ответы, ошибки API повторяем
+                    if country_code:
+                        if len(_GEOIP_CACHE) >= GEOIP_CACHE_MAX_SIZE:
+                            _GEOIP_CACHE.pop(next(iter(_GEOIP_CACHE)))
+                        _GEOIP_CACHE[cache_key] = (time.monotonic() + GEOIP_CACHE_TTL, country_code)
+                    return country_code
                 
         return None
         
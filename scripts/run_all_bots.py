@@ -15,6 +15,7 @@ sys.path.append(str(Path(__file__).parent.parent))
 from loguru import logger
 from config.settings import settings
 from config.database import init_database, init_redis, close_connections
+from core.services.activity_service import close_buffers
 
 
 class BotManager:
@@ -107,6 +108,38 @@ class BotManager:
             logger.error(f"❌ Background tasks error: {e}")
             raise
     
+    async def start_expiry_sweep(self):
+        """Периодический перевод истекших подписок в EXPIRED"""
+        try:
+            while not self.shutdown_event.is_set():
+                await self.expire_subscriptions()
+                
+                try:
+                    await asyncio.wait_for(
+                        self.shutdown_event.wait(),
+                        timeout=settings.SUBSCRIPTION_EXPIRY_INTERVAL
+                    )
+                    break
+                except asyncio.TimeoutError:
+                    continue
+                    
+        except Exception as e:
+            logger.error(f"❌ Expiry sweep error: {e}")
+            raise
+    
+    async def expire_subscriptions(self):
+        """Истечение подписок одним UPDATE"""
+        try:
+            from config.database import run_in_own_session
+            from core.services.subscription_service import SubscriptionService
+            
+            await run_in_own_session(
+                lambda session: SubscriptionService(session).expire_due_subscriptions()
+            )
+                
+        except Exception as e:
+            logger.error(f"Error expiring subscriptions: {e}")
+    
     async def check_expiring_subscriptions(self):
         """Проверка истекающих подписок"""
         try:
@@ -181,6 +214,11 @@ class BotManager:
             task.set_name("background_tasks")
             tasks.append(task)
             
+            # Истечение подписок
+            task = asyncio.create_task(self.start_expiry_sweep())
+            task.set_name("expiry_sweep")
+            tasks.append(task)
+            
             self.tasks = tasks
             
             logger.info(f"✅ Started {len(tasks)} services")
@@ -209,6 +247,9 @@ class BotManager:
         if self.tasks:
             await asyncio.gather(*self.tasks, return_exceptions=True)
         
+        # Дописываем накопленные записи активности и истории серверов
+        await close_buffers()
+        
         # Закрываем соединения
         await close_connections()
         